@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from options import SHEET_OPTIONS
+from sample_bank import SampleBank, PREVIEW_DOWNSAMPLE
+from render_cache import MeasureCache
+from score import load_score
+from profiling import Profiler
+
+# 批次匯出：不需互動、不需音效裝置，多個樂譜平行渲染
+# 用法：
+#   python3 batch.py river wedding
+#   python3 batch.py --all -j 4 -o out
+#   python3 batch.py --dir my_sheets
+
+_sample_bank = None  # 每個 worker 行程連接到同一份共享記憶體中的音色庫，不需要重新解碼
+_render_cache = None
+_preview_bank = None  # 預覽用音色庫也由主行程建立一次並共享，worker 不會同時編譯同一個檔案
+
+
+def _init_worker(notes_dir, cache_dir=None, shared=None, preview_shared=None):
+    global _sample_bank, _render_cache, _preview_bank
+    _sample_bank = SampleBank.attach_shared(shared) if shared else SampleBank(notes_dir)
+    if preview_shared:
+        _preview_bank = SampleBank.attach_shared(preview_shared)
+    if cache_dir:
+        _render_cache = MeasureCache(cache_dir)
+
+
+def load_sheet(source):
+    # source 可以是 sheets 裡的樂譜名稱、樂譜模組的檔案路徑或編譯後的樂譜(.score)
+    from main import load_sheet_music, load_sheet_module, sheet_from_module
+    if source.endswith('.score'):
+        return load_score(source)
+    if not source.endswith('.py'):
+        return load_sheet_music(source)
+
+    name = os.path.splitext(os.path.basename(source))[0]
+    return sheet_from_module(load_sheet_module(source, f'sheets_{name}'))
+
+
+def render_sheet(source, output_dir, stream=False, precision='float64', preview=False, tail=None, profile=False):
+    # 在 worker 行程中渲染一份樂譜，回傳 (輸出檔名, 秒數, 效能紀錄或 None)
+    from main import create_generator
+    start = time.perf_counter()
+    sheet_data = load_sheet(source)
+    if not sheet_data:
+        raise ValueError(f"無法載入樂譜 '{source}'")
+
+    name = os.path.splitext(os.path.basename(source))[0]
+    filename = os.path.join(output_dir, f'{name}_preview.wav' if preview else f'{name}.wav')
+    profiler = Profiler() if profile else None
+    piano_gen = create_generator(sheet_data, sample_bank=_sample_bank, render_cache=_render_cache,
+                                 precision=precision, profiler=profiler)
+    piano_gen.render_threads = 1  # 行程池已經讓每個核心各渲染一份樂譜
+    if preview:
+        if _preview_bank is not None:
+            piano_gen.preview_banks[(PREVIEW_DOWNSAMPLE, True)] = _preview_bank
+        piano_gen = piano_gen.preview(tail=tail)
+    piano_gen.write_wav(filename, stream=stream)
+    report = None
+    if profiler:
+        profiler.stop()
+        report = profiler.report()
+    return filename, time.perf_counter() - start, report
+
+
+def collect_sources(args):
+    sources = list(args.sheets)
+    if args.all:
+        sources += [sheet_name for sheet_name, _ in SHEET_OPTIONS.values()]
+    if args.dir:
+        sources += sorted(os.path.join(args.dir, f) for f in os.listdir(args.dir)
+                          if f.endswith(('.py', '.score')) and not f.startswith('_'))
+    return list(dict.fromkeys(sources))
+
+
+def run_batch(sources, output_dir='.', jobs=None, stream=False, notes_dir='notes', cache_dir=None,
+              precision='float64', preview=False, tail=None, profile=False):
+    # 回傳 {樂譜: (輸出檔名, 秒數, 效能紀錄或 None) 或例外}
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    # 音色庫只在主行程解碼一次並放進共享記憶體，N 個 worker 的記憶體用量與一個差不多
+    sample_bank = SampleBank(notes_dir)
+    shared = sample_bank.publish_shared()
+    preview_bank = None
+    preview_shared = None
+    try:
+        if preview:
+            # 冷快取時預覽用音色庫在這裡編譯一次，worker 直接連接共享記憶體
+            preview_bank = SampleBank(notes_dir, downsample=PREVIEW_DOWNSAMPLE, mono=True)
+            preview_shared = preview_bank.publish_shared()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(notes_dir, cache_dir, shared, preview_shared)) as pool:
+            futures = {pool.submit(render_sheet, source, output_dir, stream, precision, preview, tail, profile): source
+                       for source in sources}
+            for future in as_completed(futures):
+                source = futures[future]
+                try:
+                    filename, seconds, report = future.result()
+                    print(f"完成 {source}: {seconds:.2f} 秒 -> {filename}")
+                    results[source] = (filename, seconds, report)
+                except Exception as e:
+                    print(f"失敗 {source}: {e}")
+                    results[source] = e
+    finally:
+        sample_bank.close_shared()
+        if preview_bank is not None:
+            preview_bank.close_shared()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次匯出樂譜為 WAV 檔案")
+    parser.add_argument('sheets', nargs='*', help="樂譜名稱(sheets 資料夾)、樂譜模組路徑或編譯後的樂譜(.score)")
+    parser.add_argument('--all', action='store_true', help="匯出 SHEET_OPTIONS 裡的所有樂譜")
+    parser.add_argument('--dir', help="匯出資料夾中所有的樂譜模組")
+    parser.add_argument('-o', '--output', default='.', help="輸出資料夾")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker 數量(預設為 CPU 核心數)")
+    parser.add_argument('--stream', action='store_true', help="使用串流匯出，記憶體用量固定")
+    parser.add_argument('--precision', choices=['float64', 'float32', 'int32'], default='float64',
+                        help="混音精度，float32/int32 記憶體用量約減半")
+    parser.add_argument('--cache', help="區段渲染快取資料夾，只重新渲染內容改變的區段")
+    parser.add_argument('--notes', default='notes', help="音色庫資料夾(可為稀疏音色庫，缺少的鍵會移調合成)")
+    parser.add_argument('--preview', action='store_true', help="快速預覽：11025 Hz 單聲道，輸出 <樂譜>_preview.wav")
+    parser.add_argument('--tail', type=float, help="預覽時音符尾巴最長秒數")
+    parser.add_argument('--profile', metavar='JSON', help="把每份樂譜各階段的時間/記憶體紀錄存成 JSON")
+    args = parser.parse_args(argv)
+
+    sources = collect_sources(args)
+    if not sources:
+        parser.error("請指定樂譜、--all 或 --dir")
+
+    start = time.perf_counter()
+    results = run_batch(sources, args.output, args.jobs, args.stream, notes_dir=args.notes, cache_dir=args.cache,
+                        precision=args.precision, preview=args.preview, tail=args.tail,
+                        profile=bool(args.profile))
+    failures = [source for source, result in results.items() if isinstance(result, Exception)]
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            json.dump({source: result[2] for source, result in results.items()
+                       if not isinstance(result, Exception)}, f, indent=2)
+    print(f"共 {len(sources)} 份樂譜，失敗 {len(failures)} 份，總耗時 {time.perf_counter() - start:.2f} 秒")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
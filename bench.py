@@ -0,0 +1,230 @@
+import gc
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from main import PianoMusicGenerator, load_sheet_music
+from sample_bank import SampleBank, SAMPLE_RATE
+
+# 效能基準測試：載入、渲染、混音記憶體與播放排程抖動
+# 用法：
+#   python3 bench.py -o bench.json
+#   python3 bench.py -o new.json --baseline bench.json --threshold 1.2
+# 指標名稱的結尾決定方向：_seconds / _bytes 越小越好，_per_second / _factor 越大越好
+# 毫秒等級的指標容易受雜訊影響：變差的絕對量小於 NOISE_FLOORS 時不算退步
+# (_per_second / _factor 由同名的 _seconds 換算，以對應的秒數判斷)
+
+REAL_SHEETS = ['river', 'wedding']
+SYNTHETIC_SIZES = [1000, 10000, 100000]
+MIN_BENCH_SECONDS = 1.0  # best_of 至少量測這麼久(很快的函式會多跑幾次)
+# 指標結尾 -> 容許的絕對變化量(依序比對，第一個符合的為準)；
+# 排程延遲本身只有幾毫秒，使用各自的小容許量，否則放大十幾倍也不會被判定為退步
+NOISE_FLOORS = {
+    'schedule_lateness_mean_seconds': 0.0005,
+    'schedule_lateness_p99_seconds': 0.005,
+    'schedule_lateness_max_seconds': 0.005,
+    'schedule_cpu_seconds': 0.005,
+    '_seconds': 0.02,
+    '_bytes': 1 << 20,
+}
+RATE_SUFFIXES = ('_notes_per_second', '_realtime_factor')  # 由 <名稱>_seconds 換算的指標
+
+
+def best_of(func, repeat=3, min_seconds=MIN_BENCH_SECONDS, max_repeat=50):
+    best = float('inf')
+    total = 0.0
+    runs = 0
+    while runs < repeat or (total < min_seconds and runs < max_repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best
+
+
+def synthetic_sheet(num_notes, chord_size=1, seed=0):
+    # 隨機產生 num_notes 個音符的樂譜；chord_size > 1 時每一步都是密集和弦
+    rng = np.random.default_rng(seed)
+    steps = max(num_notes // chord_size, 1)
+    notes = rng.integers(-20, 30, size=(steps, chord_size)).tolist()
+    score = [chord if chord_size > 1 else chord[0] for chord in notes]
+    beat = [0.25] * steps
+    return 240, score, beat, [0], [sum(beat)]
+
+
+def bench_load(results, sheet_data):
+    tempo, right_score, right_beat, left_score, left_beat = sheet_data
+    results['load_cold_seconds'] = best_of(lambda: PianoMusicGenerator(
+        *sheet_data, sample_bank=SampleBank(use_compiled=False)))
+    results['load_compiled_seconds'] = best_of(lambda: PianoMusicGenerator(
+        *sheet_data, sample_bank=SampleBank()))
+    warm_bank = SampleBank()
+    warm_bank.preload(SampleBank.scan(right_score, left_score))
+    results['load_warm_seconds'] = best_of(lambda: PianoMusicGenerator(*sheet_data, sample_bank=warm_bank))
+
+
+def bench_render_sheet(results, name, sample_bank):
+    piano_gen = PianoMusicGenerator(*load_sheet_music(name), sample_bank=sample_bank)
+    hands = [(piano_gen.right_score, piano_gen.right_beat, 'right'),
+             (piano_gen.left_score, piano_gen.left_beat, 'left')]
+    num_notes = sum(len(piano_gen.plan_hand(*hand).onsets) for hand in hands)
+    audio_seconds = max(sum(beat) * piano_gen.quarter_duration for _, beat, _ in hands)
+
+    seconds = best_of(lambda: [piano_gen.generate_wav_data(*hand) for hand in hands])
+    results[f'render_{name}_seconds'] = seconds
+    results[f'render_{name}_notes_per_second'] = num_notes / seconds
+    results[f'render_{name}_realtime_factor'] = audio_seconds / seconds
+
+
+def bench_render_synthetic(results, num_notes, chord_size, sample_bank):
+    # 以區塊方式渲染(結果丟棄)，大型合成樂譜也不會用光記憶體
+    piano_gen = PianoMusicGenerator(*synthetic_sheet(num_notes, chord_size), sample_bank=sample_bank)
+    plan = piano_gen.plan_hand(piano_gen.right_score, piano_gen.right_beat)
+    renderer = piano_gen.renderer
+
+    def render():
+        for start in range(0, plan.total_samples, 1 << 16):
+            renderer.render_block(plan, start, min(start + (1 << 16), plan.total_samples))
+
+    label = f'synthetic_{num_notes}' + (f'_chord{chord_size}' if chord_size > 1 else '')
+    # 只有最大的合成樂譜只量一次(每次要好幾秒)，其他的取三次中最好的
+    seconds = best_of(render, repeat=1 if num_notes >= SYNTHETIC_SIZES[-1] else 3)
+    results[f'render_{label}_seconds'] = seconds
+    results[f'render_{label}_notes_per_second'] = len(plan.onsets) / seconds
+    results[f'render_{label}_realtime_factor'] = plan.total_samples / SAMPLE_RATE / seconds
+
+
+def bench_export_memory(results, name, sample_bank):
+    piano_gen = PianoMusicGenerator(*load_sheet_music(name), sample_bank=sample_bank)
+    for stream in (False, True):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tracemalloc.start()
+            piano_gen.write_wav(os.path.join(tmp_dir, f'{name}.wav'), stream=stream)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[f'export_{name}_{"stream" if stream else "memory"}_peak_bytes'] = peak
+
+
+class StubChannel:
+    def get_busy(self):
+        return False
+
+    def set_volume(self, *volume):
+        pass
+
+    def fadeout(self, ms):
+        pass
+
+
+class StubSound:
+    def play(self, loops=0, maxtime=0):
+        return StubChannel()
+
+
+class StubMixer:
+    # 不需音效裝置的 mixer 替身，只用來量測排程
+    def get_num_channels(self):
+        return 50
+
+
+def bench_scheduling(results, sample_bank, num_notes=64, repeat=3):
+    # 2 秒內排程 num_notes 個音符，量測 play_hand_part 的觸發延遲；
+    # 單次執行的最大延遲受雜訊影響很大，與 best_of 相同，每個統計值取 repeat 次中最好的一次
+    tempo, score, _, _, _ = synthetic_sheet(num_notes)
+    beat = [2 * tempo / 60 / num_notes] * num_notes
+    piano_gen = PianoMusicGenerator(tempo, score, beat, [0], [sum(beat)], sample_bank=sample_bank)
+    piano_gen.mixer = StubMixer()
+    piano_gen.decay_time = 0
+    piano_gen.get_piano_sound = lambda note_num: StubSound()
+
+    runs = []
+    for _ in range(repeat):
+        gc.collect()
+        cpu_start = time.process_time()
+        asyncio.run(piano_gen.play_hand_part(score, beat))
+        cpu_seconds = time.process_time() - cpu_start
+        lateness = np.array([late for _, late in piano_gen.note_lateness])
+        runs.append({
+            'schedule_lateness_mean_seconds': float(lateness.mean()),
+            'schedule_lateness_p99_seconds': float(np.percentile(lateness, 99)),
+            'schedule_lateness_max_seconds': float(lateness.max()),
+            'schedule_cpu_seconds': cpu_seconds,
+        })
+    for key in runs[0]:
+        results[key] = min(run[key] for run in runs)
+
+
+def run_benchmarks(sizes=SYNTHETIC_SIZES):
+    results = {}
+    sample_bank = SampleBank()
+    bench_load(results, load_sheet_music('river'))
+    for name in REAL_SHEETS:
+        bench_render_sheet(results, name, sample_bank)
+    for num_notes in sizes:
+        bench_render_synthetic(results, num_notes, 1, sample_bank)
+    bench_render_synthetic(results, sizes[0], 8, sample_bank)
+    bench_export_memory(results, 'river', sample_bank)
+    bench_scheduling(results, sample_bank)
+    return results
+
+
+def above_noise(key, old, new):
+    floor = next((value for suffix, value in NOISE_FLOORS.items() if key.endswith(suffix)), 0)
+    return new - old > floor
+
+
+def compare(results, baseline, threshold):
+    # 回傳退步的指標：[(名稱, 基準值, 目前值)]
+    regressions = []
+    for key, old in baseline.items():
+        new = results.get(key)
+        if new is None or old <= 0:
+            continue
+        if key.endswith(('_per_second', '_factor')):
+            worse = new < old / threshold
+            suffix = next((suffix for suffix in RATE_SUFFIXES if key.endswith(suffix)), None)
+            seconds_key = suffix and key[:-len(suffix)] + '_seconds'
+            if worse and seconds_key in baseline and seconds_key in results:
+                worse = above_noise(seconds_key, baseline[seconds_key], results[seconds_key])
+        else:
+            worse = new > old * threshold and above_noise(key, old, new)
+        if worse:
+            regressions.append((key, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PianoMusicGenerator 效能基準測試")
+    parser.add_argument('-o', '--output', help="結果輸出的 JSON 檔案")
+    parser.add_argument('--baseline', help="用來比較的舊結果 JSON 檔案")
+    parser.add_argument('--threshold', type=float, default=1.2, help="容許的退步倍數")
+    parser.add_argument('--quick', action='store_true', help="略過 100k 音符的合成樂譜")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(SYNTHETIC_SIZES[:-1] if args.quick else SYNTHETIC_SIZES)
+    for key, value in results.items():
+        print(f"{key}: {value:.6g}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for key, old, new in regressions:
+            print(f"效能退步 {key}: {old:.6g} -> {new:.6g}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
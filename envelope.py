@@ -0,0 +1,114 @@
+import functools
+import numpy as np
+
+# 包絡線引擎：起音(attack)與釋放(release)曲線只計算一次並快取，
+# 踏板的踩下/放開是時間軸上的事件，釋放區間以向量化乘法套用到混音上。
+# 匯出與軟體混音播放使用同一份踏板時間軸(pygame 聲道播放無法逐取樣點調整音量，不套用踏板)
+#
+# 樂譜指定踏板時，放開踏板等於制音器落下：在那之前按下、仍在發聲的音符從放開的時間點起，
+# 在 fade_samples 內以釋放曲線收尾，之後不再發聲；踏板放開期間彈的音符不受這次放開影響。
+# 樂譜沒有指定踏板時，每小節踩一次：小節結尾前 fade_samples 整段混音以釋放曲線淡出，
+# 結尾時再踩下，尾音繼續(與沒有踏板事件的舊版逐位元相同)
+# 起音曲線已預先套用在音色庫的波形上，混音時不需逐音符相乘
+
+PEDAL_DTYPE = np.dtype([
+    ('position', np.int64),  # 取樣點
+    ('down', np.bool_),      # True: 踩下 / False: 放開
+])
+
+
+@functools.lru_cache(maxsize=None)
+def attack_curve(fade_samples):
+    curve = (1 - np.cos(np.linspace(0, np.pi/2, fade_samples)))[:, np.newaxis]
+    curve.flags.writeable = False  # 快取共用，不可修改
+    return curve
+
+
+@functools.lru_cache(maxsize=None)
+def release_curve(fade_samples):
+    curve = np.cos(np.linspace(0, np.pi/2, fade_samples))
+    curve.flags.writeable = False
+    return curve
+
+
+def pedal_timeline(fade_positions, fade_samples):
+    # 由每小節結尾的位置產生踏板事件：曲子開頭踩下，每個小節結尾前放開、結尾時再踩下
+    positions = np.asarray(fade_positions, dtype=np.int64)
+    pedal = np.zeros(1 + 2 * len(positions), dtype=PEDAL_DTYPE)
+    pedal[0] = (0, True)
+    pedal['position'][1::2] = positions - np.minimum(fade_samples, positions)
+    pedal['position'][2::2] = positions
+    pedal['down'][2::2] = True
+    return pedal
+
+
+def pedal_from_beats(beats, down, tempo, sample_rate):
+    # 樂譜中以拍數記錄的踏板事件轉成取樣點的時間軸(依時間排序，同一時間點保持原順序)
+    pedal = np.zeros(len(beats), dtype=PEDAL_DTYPE)
+    pedal['position'] = (np.asarray(beats, dtype=np.float64) * (60 / tempo) * sample_rate).astype(np.int64)
+    pedal['down'] = down
+    return pedal[np.argsort(pedal['position'], kind='stable')]
+
+
+class Envelope:
+    def __init__(self, pedal, fade_samples, dampers=True):
+        self.pedal = pedal
+        self.fade_samples = fade_samples
+        self.dampers = dampers  # True：放開踏板時逐音符收尾；False：每小節整段混音淡出
+        self.release = release_curve(fade_samples)
+        down = pedal['down']
+        # 實際放開踏板的時間點：踩下狀態之後的放開事件(曲子開頭視為沒有踩下)
+        was_down = np.zeros(len(down), dtype=np.bool_)
+        was_down[1:] = down[:-1]
+        self.up_positions = pedal['position'][~down & was_down]
+        if dampers:
+            self.release_starts = np.zeros(0, dtype=np.int64)
+            self.release_stops = np.zeros(0, dtype=np.int64)
+            return
+        # 釋放區間：每次放開踏板到下一個踩下事件為止(最長 fade_samples)，使用釋放曲線的前段
+        positions = np.append(pedal['position'], np.iinfo(np.int64).max)
+        up = np.flatnonzero(~down)
+        downs = np.append(np.flatnonzero(down), len(pedal))
+        next_down = downs[np.searchsorted(downs, up)]
+        self.release_starts = pedal['position'][up]
+        self.release_stops = np.minimum(positions[next_down], self.release_starts + fade_samples)
+
+    @classmethod
+    def from_measures(cls, fade_positions, fade_samples):
+        return cls(pedal_timeline(fade_positions, fade_samples), fade_samples, dampers=False)
+
+    def damp(self, onsets, counts):
+        # 每個音符在按下之後第一次放開踏板時收尾：回傳 (收尾起點, 縮短後的延音長度)，
+        # 收尾起點為 -1 表示不受踏板影響(放開前已結束，或之後沒有再放開)
+        releases = np.full(len(onsets), -1, dtype=np.int64)
+        if not self.dampers or not len(self.up_positions):
+            return releases, counts
+        index = np.searchsorted(self.up_positions, onsets, 'right')
+        damped = index < len(self.up_positions)
+        up = self.up_positions[np.minimum(index, len(self.up_positions) - 1)]
+        damped &= up < onsets + counts
+        releases[damped] = up[damped]
+        counts = np.where(damped, np.minimum(counts, up - onsets + self.fade_samples), counts)
+        return releases, counts
+
+    def windows(self, start, stop):
+        # 與 [start, stop) 重疊的釋放區間 [(起點, 終點), ...]
+        lo = np.searchsorted(self.release_stops, start, 'right')
+        hi = np.searchsorted(self.release_starts, stop, 'left')
+        return zip(self.release_starts[lo:hi].tolist(), self.release_stops[lo:hi].tolist())
+
+    def apply(self, audio_data, start=0):
+        # 把釋放曲線乘進 audio_data(在整首曲子中的起始位置為 start)：
+        # 只觸碰釋放區間內的取樣點，每個區間一次向量化乘法，增益為 1 的部分不產生任何暫存陣列
+        stop = start + len(audio_data)
+        for a0, b0 in self.windows(start, stop):
+            a, b = max(a0, start), min(b0, stop)
+            if a >= b:
+                continue
+            segment = audio_data[a - start:b - start]
+            curve = self.release[a - a0:b - a0, np.newaxis]
+            if segment.dtype.kind == 'i':
+                segment[:] = np.rint(segment * curve)
+            else:
+                segment *= curve
+        return audio_data
@@ -1,45 +1,79 @@
-import pygame
+import os
+import copy
 import asyncio
 import platform
-import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.io import wavfile
-import warnings
 from notes import piano_notes, note_to_name
+from sample_bank import SampleBank, SAMPLE_RATE, PREVIEW_DOWNSAMPLE
+from scheduler import PlaybackScheduler
+from score import Track, CompiledScore, compile_tracks, compile_pedal, hand_tracks
+from renderer import Renderer, compile_events, events_from_part, write_wav_blocks, pan_gains, segment_ranges, BLOCK_SIZE
+from mixer import SoftwareMixer, MAX_VOICES
 from options import SHEET_OPTIONS
-import importlib
+from profiling import Profiler, NULL_PROFILER
+from envelope import pedal_from_beats
+import importlib.util
 
-warnings.filterwarnings("ignore", category=wavfile.WavFileWarning)
-
-pygame.init()
-pygame.mixer.set_num_channels(50)  # 支援多聲道
 FPS = 60
-SAMPLE_RATE = 44100  # WAV 檔案的取樣率
+NUM_CHANNELS = 50  # 支援多聲道
+SHEETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheets')
+PLAYBACK_BLOCK = 11025  # 軟體混音每次送出的取樣點數(0.25 秒)
+
+AUDIO_FORMAT = (SAMPLE_RATE, -16, 2)  # 播放裝置格式：取樣率、16-bit 有號整數、立體聲
+
+def init_audio():
+    # 只有真的要播放時才載入 pygame 並初始化音效裝置，純匯出(無音效卡的伺服器)完全不會用到
+    # 播放直接送出 44.1kHz 立體聲 16-bit 的取樣點，裝置格式必須固定(allowedchanges=0)：
+    # 不讓 SDL 改用裝置原生的取樣率或聲道數，否則音高、速度或聲道排列會錯
+    import pygame
+    if pygame.mixer.get_init() != AUDIO_FORMAT:
+        pygame.mixer.quit()
+        pygame.mixer.pre_init(*AUDIO_FORMAT, allowedchanges=0)
+        pygame.init()
+        pygame.mixer.set_num_channels(NUM_CHANNELS)
+    return pygame
 
 class PianoMusicGenerator:
-    def __init__(self, tempo, right_score, right_beat, left_score, left_beat):
+    def __init__(self, tempo, right_score=None, right_beat=None, left_score=None, left_beat=None, sample_bank=None,
+                 render_cache=None, precision='float64', tracks=None, profiler=None, score=None):
         
+        self.profiler = profiler or NULL_PROFILER  # 各階段的時間/記憶體紀錄(profiling.Profiler)
         self.piano_notes = piano_notes   # 鋼琴音符名稱
         self.note_to_name = note_to_name # 音符數字到音符名稱的映射
 
-        self.sound_cache = {}
-        self.wav_data_cache = {}  # 用於匯出WAV的原始數據
-        required_notes = set(self.note_to_name.values())
-        
-        for note in required_notes:
-            try:
-                # 載入用於播放的音效
-                self.sound_cache[note] = pygame.mixer.Sound(f'notes/{note}.wav')
-                # 載入用於匯出的原始WAV數據
-                _, wav_data = wavfile.read(f'notes/{note}.wav')
-                # 確保數據是立體聲
-                if wav_data.ndim == 1:  # 單聲道轉立體聲
-                    wav_data = np.column_stack((wav_data, wav_data))
-                self.wav_data_cache[note] = wav_data
-            except FileNotFoundError:
-                print(f"警告: 找不到 notes/{note}.wav，該音符將無聲")
-                self.sound_cache[note] = None
-                self.wav_data_cache[note] = np.zeros((SAMPLE_RATE, 2), dtype=np.int16)
+        # 樂譜軌道：沒有指定 tracks 時為原本的右手、左手兩軌；
+        # 指定已編譯的 score(CompiledScore)時直接使用其陣列，score/beat 等聲道播放需要時才轉回 list
+        if score is not None:
+            tracks = score.to_tracks(sheets=False)
+        elif tracks is None:
+            tracks = hand_tracks(right_score, right_beat, left_score, left_beat)
+        self.tracks = tracks
+
+        # 只載入樂譜用到的音符，播放與匯出共用同一份解碼資料
+        self.sample_bank = sample_bank if sample_bank is not None else SampleBank()
+        if score is not None:
+            names = {note_to_name[n] for n in np.unique(score.events['note']).tolist() if n != 0}
+        else:
+            names = SampleBank.scan(*[track.score for track in tracks])
+        with self.profiler.stage('load_samples', count=len(names)):
+            self.sample_bank.preload(names)
+        self.renderer = Renderer(self.sample_bank, precision)  # 混音精度：float64 / float32 / int32
+        self.render_cache = render_cache  # MeasureCache：只重新渲染內容改變的區段
+        self.mixer = None  # 播放用的 mixer，None 表示 pygame.mixer(測試時可換成替身)
+        self.active_channels = deque()
+        self.note_lateness = []  # 最近一次聲道播放每個音符的 (聲部, 延遲秒數)
+        self.block_lateness = []  # 最近一次軟體混音播放每個區塊的 ('block', 延遲秒數)
+        self.export_executor = None  # 匯出用的執行緒池，None 表示使用事件迴圈預設的執行緒池
+        self.render_threads = os.cpu_count() or 1  # 匯出時平行渲染各時間區段的執行緒數，1 表示循序渲染
+        self.playback = 'software'  # 'software': 軟體混音成單一串流 / 'channels': 每個音符一個 pygame 聲道
+        self.max_voices = MAX_VOICES  # 軟體混音的最大複音數
+        self.voice_stealing = 'oldest'  # 超過複音數時搶走的音符：'oldest' / 'quietest'
+        self.stolen_voices = []  # 最近一次軟體混音播放被搶走的音符
+        self.tail = None  # 音符尾巴最長秒數(預覽用)，None 表示完整延音
+        self.preview_banks = {}  # (downsample, mono) -> 預覽用的低解析度音色庫
         
         # 播放參數
         self.tempo = tempo  # 拍子的速度(Beats Per Minute, BPM)
@@ -47,11 +81,9 @@ class PianoMusicGenerator:
         self.measure_duration = 4 * self.quarter_duration  # 小節時長
         self.decay_time = 0.5  # 額外衰減時間
         self.max_duration = self.measure_duration + self.decay_time  # 音符最大播放時長
-        self.fade_samples = int(0.05 * SAMPLE_RATE)  # 增加到50ms淡入時間
+        self.fade_samples = self.sample_bank.fade_samples  # 50ms淡入時間(已預先套用在音色資料上)
         
-        # 音量參數
-        self.right_volume = 0.7  # 右手音量
-        self.left_volume = 0.5   # 左手音量
+        # 音量參數(每一軌的音量與左右平衡在 self.tracks 裡)
         self.max_amplitude = 32767 * 0.7  # 降低最大振幅
         
         # 樂譜數據
@@ -59,6 +91,41 @@ class PianoMusicGenerator:
         self.right_beat = right_beat
         self.left_score = left_score
         self.left_beat = left_beat
+        if score is None:
+            with self.profiler.stage('compile_score', count=len(tracks)):
+                score = compile_tracks(tempo, tracks)
+        self.score = score  # 驗證並攤平的樂譜陣列
+    
+    @classmethod
+    def from_score(cls, compiled, sample_bank=None, render_cache=None, precision='float64', profiler=None):
+        # 由編譯後的樂譜(score.load_score)建立，直接使用其陣列，不逐音符重新編譯
+        return cls(compiled.tempo, sample_bank=sample_bank, render_cache=render_cache,
+                   precision=precision, profiler=profiler, score=compiled)
+    
+    def get_track(self, name):
+        # name 可以是軌道名稱或索引
+        if isinstance(name, int):
+            return self.tracks[name]
+        for track in self.tracks:
+            if track.name == name:
+                return track
+        raise KeyError(f"沒有名為 '{name}' 的軌道")
+    
+    @property
+    def right_volume(self):
+        return self.get_track('right').gain
+    
+    @right_volume.setter
+    def right_volume(self, volume):
+        self.get_track('right').gain = volume
+    
+    @property
+    def left_volume(self):
+        return self.get_track('left').gain
+    
+    @left_volume.setter
+    def left_volume(self, volume):
+        self.get_track('left').gain = volume
     
     def get_piano_sound(self, note_num):
         if note_num == 0:
@@ -67,186 +134,324 @@ class PianoMusicGenerator:
         if not note_name:
             print(f"警告: 無效音符 {note_num}")
             return None
-        return self.sound_cache.get(note_name)
+        return self.sample_bank.get_sound(note_name)
     
     def get_wav_data(self, note_num):
         if note_num == 0:
-            return np.zeros((SAMPLE_RATE, 2), dtype=np.int16)
+            return np.zeros((SAMPLE_RATE, 2), dtype=np.float32)
         note_name = self.note_to_name.get(note_num)
         if not note_name:
             print(f"警告: 無效音符 {note_num}")
-            return np.zeros((SAMPLE_RATE, 2), dtype=np.int16)
-        return self.wav_data_cache.get(note_name, np.zeros((SAMPLE_RATE, 2), dtype=np.int16))
+            return np.zeros((SAMPLE_RATE, 2), dtype=np.float32)
+        return self.sample_bank.get(note_name)
     
-    async def play_hand_part(self, score, beat, hand='right'):
-        start_time = time.time()
+    def schedule_hand_part(self, scheduler, score, beat, hand='right'):
+        # 把一個聲部的音符排入排程器，回傳該聲部結束的時間(秒)；hand 可以是軌道名稱或索引
+        # pygame 聲道無法逐取樣點調整音量，這裡不套用踏板的釋放曲線(與匯出不同)；
+        # 預設的軟體混音播放與匯出使用同一份包絡線
         next_note_time = 0.0
-        active_channels = []
-        volume = self.right_volume if hand == 'right' else self.left_volume
+        track = self.get_track(hand)
+        volume = tuple((track.gain * pan_gains(track.pan)).tolist())  # (左聲道, 右聲道)
 
         for note, beat_value in zip(score, beat):
-            duration = self.quarter_duration * beat_value
-            
-            # 清理過期的聲道
-            current_time = time.time() - start_time
-            active_channels = [
-                (ch, st) for ch, st in active_channels
-                if ch.get_busy() and (current_time - st) < self.max_duration
-            ]
-            
-            # 等待到下一個音符的時間點
-            while (time.time() - start_time) < next_note_time:
-                await asyncio.sleep(0.001)
-            
-            # 播放音符
-            sounds = []
-            if isinstance(note, list):
-                sounds = [self.get_piano_sound(n) for n in note if n != 0]
-            elif note != 0:
-                sounds = [self.get_piano_sound(note)]
-                
-            for sound in sounds:
-                if sound:
-                    channel = sound.play(0, int(self.max_duration * 1000))
-                    if channel:
-                        channel.set_volume(volume)
-                        active_channels.append((channel, time.time() - start_time))
-            
-            next_note_time += duration
+            notes = [n for n in (note if isinstance(note, list) else [note]) if n != 0]
+            if notes:
+                scheduler.add(next_note_time, self.play_notes, notes, volume, tag=track.name)
+            next_note_time += self.quarter_duration * beat_value
         
-        # 只停止已經超過最大時長的音符
-        if active_channels:
-            expected_end_time = next_note_time + self.decay_time
-            
-            while True:
-                current_time = time.time() - start_time
-                # 移除已完成播放的聲道
-                active_channels = [
-                    (ch, st) for ch, st in active_channels
-                    if ch.get_busy() and (current_time - st) < expected_end_time
-                ]
-                
-                if not active_channels:
-                    break
-                    
-                # 對最後的音符應用淡出效果
-                for channel, start_t in active_channels:
-                    elapsed = current_time - start_t
-                    remaining = expected_end_time - elapsed
-                    if remaining < 0.5:  # 最後0.5秒開始淡出
-                        channel.set_volume(volume * (remaining / 0.5))
-                
-                await asyncio.sleep(0.05)
+        return next_note_time
+    
+    def play_notes(self, notes, volume):
+        for n in notes:
+            sound = self.get_piano_sound(n)
+            if sound:
+                channel = sound.play(0, int(self.max_duration * 1000))
+                if channel:
+                    channel.set_volume(*volume)
+                    self.active_channels.append(channel)
+                else:
+                    self.profiler.add('dropped_channels')  # 沒有空閒的聲道，音符沒有發聲
+    
+    def fade_out_channels(self):
+        # 樂譜結束後，仍在發聲的音符在衰減時間內淡出
+        for channel in self.active_channels:
+            if channel.get_busy():
+                channel.fadeout(int(self.decay_time * 1000))
+        self.active_channels.clear()
+    
+    async def play_parts(self, parts):
+        # parts: [(score, beat, hand), ...]，所有聲部共用同一個排程器與時間原點
+        mixer = self.mixer or init_audio().mixer
+        scheduler = PlaybackScheduler()
+        self.active_channels = deque(maxlen=mixer.get_num_channels())
+        end_time = max(self.schedule_hand_part(scheduler, score, beat, hand) for score, beat, hand in parts)
+        scheduler.add(end_time, self.fade_out_channels)
+        scheduler.add(end_time + self.decay_time, lambda: None)  # 等待淡出結束
+        await scheduler.run()
+        self.note_lateness = scheduler.lateness
+        self.profiler.record_lateness(scheduler.lateness)
+    
+    async def play_hand_part(self, score, beat, hand='right'):
+        await self.play_parts([(score, beat, hand)])
+    
+    async def play_software(self):
+        # 軟體混音：依匯出相同的渲染計畫逐區塊混音，送進單一聲道的佇列播放
+        mixer = self.mixer or init_audio().mixer
+        soft = SoftwareMixer(self.renderer, self.plan_tracks(), self.max_voices, self.voice_stealing)
+        self.stolen_voices = soft.stolen
+        self.profiler.add('stolen_voices', len(soft.stolen))
+        if soft.stolen:
+            print(f"警告: 同時發聲超過 {self.max_voices} 個音符，{len(soft.stolen)} 個音符被提前淡出")
+        
+        # 以包絡線估計峰值上限，不必先渲染整首才開始播放
+        max_val = soft.peak_bound()
+        channel = mixer.Channel(0)
+        
+        def queue_block(start):
+            with self.profiler.stage('playback_block'):
+                block = soft.render_int16(start, min(start + PLAYBACK_BLOCK, soft.length), max_val, self.max_amplitude)
+            channel.queue(mixer.Sound(buffer=np.ascontiguousarray(block).tobytes()))
+        
+        # 每個區塊在前一個區塊播到一半時渲染並排入佇列
+        scheduler = PlaybackScheduler()
+        block_duration = PLAYBACK_BLOCK / SAMPLE_RATE
+        for i, start in enumerate(range(0, soft.length, PLAYBACK_BLOCK)):
+            scheduler.add(max(i - 0.5, 0) * block_duration, queue_block, start, tag='block')
+        scheduler.add(soft.length / SAMPLE_RATE, lambda: None)  # 等待最後一個區塊播完
+        await scheduler.run()
+        self.block_lateness = scheduler.lateness
+        self.profiler.record_lateness(scheduler.lateness, blocks=True)
     
     async def play_music(self):
         print("正在播放...")
-        await asyncio.gather(
-            self.play_hand_part(self.right_score, self.right_beat, 'right'),
-            self.play_hand_part(self.left_score, self.left_beat, 'left')
-        )
+        if self.playback == 'software':
+            await self.play_software()
+        else:
+            await self.play_parts([(*self.track_sheet(index), index) for index in range(len(self.tracks))])
         print("播放完成！")
     
+    def track_sheet(self, index):
+        # 一軌的 (score, beat)；由 .score 載入時只有聲道播放需要，第一次用到時才由陣列轉回 list
+        track = self.tracks[index]
+        if track.score is None:
+            track.score, track.beat = self.score.part_sheet(index)
+        return track.score, track.beat
+    
+    def plan_hand(self, score, beat, hand='right'):
+        track = self.get_track(hand)
+        with self.profiler.stage('plan') as stage:
+            events, total_samples, fade_positions = compile_events(score, beat, self.tempo, track.gain)
+            stage.count = len(events)
+            pedal = None
+            if track.pedal is not None:
+                pedal = self.pedal_timeline(compile_pedal(track.pedal))
+            return self.renderer.plan(events, total_samples, fade_positions, track.pan, self.tail, pedal)
+    
+    def plan_part(self, hand='right'):
+        # 直接使用編譯後的樂譜陣列建立渲染計畫；hand 可以是軌道名稱或索引
+        index = self.score.index(hand)
+        track = self.tracks[index]
+        with self.profiler.stage('plan') as stage:
+            events, total_samples, fade_positions = events_from_part(
+                self.score.part(index), self.score.total_beats[index], self.tempo, track.gain)
+            stage.count = len(events)
+            pedal = self.score.pedal(index)
+            if pedal is not None:
+                pedal = self.pedal_timeline(pedal)
+            return self.renderer.plan(events, total_samples, fade_positions, track.pan, self.tail, pedal)
+    
+    def pedal_timeline(self, pedal):
+        # 樂譜的踏板事件(score.PEDAL_SCORE_DTYPE，以拍數計)轉成取樣點的時間軸
+        return pedal_from_beats(pedal['beat'], pedal['down'], self.tempo, SAMPLE_RATE)
+    
+    def plan_tracks(self):
+        return [self.plan_part(index) for index in range(len(self.tracks))]
+    
+    def render_plan(self, plan):
+        with self.profiler.stage('render', count=len(plan.onsets)):
+            if self.render_cache is not None:
+                audio_data = np.zeros((plan.total_samples, self.renderer.channels), dtype=self.renderer.dtype)
+                for start, stop in segment_ranges(plan, plan.total_samples):
+                    self.mix_segment([plan], start, stop, out=audio_data[start:stop])
+                return audio_data
+            return self.renderer.render_block(plan, 0, plan.total_samples)
+    
+    def mix_segment(self, plans, start, stop, out=None):
+        # 混合一個時間區段的所有軌道；有區段快取時只渲染內容改變的區段
+        if self.render_cache is not None:
+            return self.renderer.render_tracks_cached(plans, start, stop, self.render_cache, out=out)
+        return self.renderer.render_tracks(plans, start, stop, out=out)
+    
     def generate_wav_data(self, score, beat, hand='right'):
-        total_samples = int(sum(beat) * self.quarter_duration * SAMPLE_RATE)
-        audio_data = np.zeros((total_samples, 2), dtype=np.float64)
-        current_pos = 0
-        current_measure_beats = 0
-        volume = self.right_volume if hand == 'right' else self.left_volume
-        
-        fade_in = (1 - np.cos(np.linspace(0, np.pi/2, self.fade_samples)))[:, np.newaxis]
-        fade_out = (np.cos(np.linspace(0, np.pi/2, self.fade_samples)))[:, np.newaxis]
-        
-        for note, beat_value in zip(score, beat):
-            duration_samples = int(beat_value * self.quarter_duration * SAMPLE_RATE)
-            measure_samples = int(self.measure_duration * SAMPLE_RATE)
-            sustain_samples = min(measure_samples, total_samples - current_pos)
-            
-            if isinstance(note, list):
-                for n in note:
-                    if n != 0:
-                        note_data = self.get_wav_data(n).astype(np.float64)
-                        end_pos = min(current_pos + sustain_samples, total_samples)
-                        segment_length = end_pos - current_pos
-                        
-                        if segment_length > note_data.shape[0]:
-                            pad_width = ((0, segment_length - note_data.shape[0]), (0, 0))
-                            note_data = np.pad(note_data, pad_width, mode='constant')
-                        
-                        segment_data = note_data[:segment_length] * volume
-                        if segment_length > self.fade_samples:
-                            segment_data[:self.fade_samples] *= fade_in
-                        
-                        audio_data[current_pos:end_pos] += segment_data
-            else:
-                if note != 0:
-                    note_data = self.get_wav_data(note).astype(np.float64)
-                    end_pos = min(current_pos + sustain_samples, total_samples)
-                    segment_length = end_pos - current_pos
-                    
-                    if segment_length > note_data.shape[0]:
-                        pad_width = ((0, segment_length - note_data.shape[0]), (0, 0))
-                        note_data = np.pad(note_data, pad_width, mode='constant')
-                    
-                    segment_data = note_data[:segment_length] * volume
-                    if segment_length > self.fade_samples:
-                        segment_data[:self.fade_samples] *= fade_in
-                    
-                    audio_data[current_pos:end_pos] += segment_data
-            
-            current_pos += duration_samples
-            current_measure_beats += beat_value
-            
-            if current_measure_beats >= 4:
-                current_measure_beats -= 4
-                fade_out_samples = min(self.fade_samples, current_pos)
-                if fade_out_samples > 0:
-                    audio_data[current_pos-fade_out_samples:current_pos] *= fade_out
-        
-        return audio_data
+        return self.render_plan(self.plan_hand(score, beat, hand))
     
-    async def export_to_wav(self, filename):
+    async def export_to_wav(self, filename, stream=False, block_size=BLOCK_SIZE, peak='exact', progress=None):
         print("正在生成WAV檔案...")
         
         if not filename.endswith('.wav'):
             filename += '.wav'
         
-        right_audio = self.generate_wav_data(self.right_score, self.right_beat, 'right')
-        left_audio = self.generate_wav_data(self.left_score, self.left_beat, 'left')
+        # 渲染是同步的 NumPy 運算，放到執行緒池執行，避免卡住事件迴圈(播放)
+        loop = asyncio.get_running_loop()
+        report = None
+        if progress:
+            report = lambda fraction: loop.call_soon_threadsafe(progress, fraction)
+        await loop.run_in_executor(self.export_executor, self.write_wav,
+                                   filename, stream, block_size, peak, report)
+        print(f"已成功匯出WAV檔案: {filename}")
+    
+    def write_wav(self, filename, stream=False, block_size=BLOCK_SIZE, peak='exact', report=None):
+        if stream:
+            self.export_stream(filename, block_size, peak, report)
+            return
         
-        min_length = min(len(right_audio), len(left_audio))
-        right_audio = right_audio[:min_length]
-        left_audio = left_audio[:min_length]
+        # 所有軌道依序加進同一個輸出緩衝區(長度取最短的一軌)，不需要每一軌各一個整首的緩衝區
+        plans = self.plan_tracks()
+        min_length = min(plan.total_samples for plan in plans)
+        # mix 包含渲染(逐區段渲染與混音合併進行，有區段快取時命中的區段直接讀取)
+        with self.profiler.stage('mix', count=len(plans)):
+            mixed_audio = np.zeros((min_length, self.renderer.channels), dtype=self.renderer.dtype)
+            # 各區段寫入輸出緩衝區中互不重疊的部分，可以交給不同執行緒
+            def render_segment(start, stop):
+                self.mix_segment(plans, start, stop, out=mixed_audio[start:stop])
+                return stop - start
+            done = 0
+            for rendered in self.map_segments(render_segment, segment_ranges(plans[0], min_length, block_size)):
+                done += rendered
+                if report:
+                    report(done / min_length * 0.9)
         
-        mixed_audio = right_audio + left_audio
+        with self.profiler.stage('normalize', count=min_length):
+            max_val = np.max(np.abs(mixed_audio))
+            if max_val > 0:
+                mixed_audio = self.renderer.to_int16(mixed_audio, max_val, self.max_amplitude)
         
-        max_val = np.max(np.abs(mixed_audio))
-        if max_val > 0:
-            mixed_audio = (mixed_audio / max_val * self.max_amplitude).astype(np.int16)
+        with self.profiler.stage('write', count=min_length):
+            wavfile.write(filename, self.renderer.sample_rate, mixed_audio)
+        if report:
+            report(1.0)
+    
+    def export_stream(self, filename, block_size=BLOCK_SIZE, peak='exact', report=None):
+        # 串流匯出：逐區塊渲染並寫檔，記憶體用量與曲長無關
+        # peak='exact' 先以同樣的區塊渲染算出峰值(結果與一次渲染整首相同)；
+        # peak='bound' 只用波形峰值估計上限，不需多渲染一次，但音量可能略小
+        plans = self.plan_tracks()
+        length = min(plan.total_samples for plan in plans)
+        ranges = segment_ranges(plans[0], length, block_size)
         
-        wavfile.write(filename, SAMPLE_RATE, mixed_audio)
-        print(f"已成功匯出WAV檔案: {filename}")
+        def mix_block(start, stop):
+            with self.profiler.stage('render'):
+                return self.mix_segment(plans, start, stop)
+        
+        # 進度：exact 模式要渲染兩輪
+        total_steps = len(ranges) * (2 if peak == 'exact' else 1)
+        
+        with self.profiler.stage('peak', count=len(ranges)):
+            if peak == 'exact':
+                max_val = 0
+                peaks = lambda start, stop: np.max(np.abs(mix_block(start, stop)))
+                for i, block_peak in enumerate(self.map_segments(peaks, ranges)):
+                    max_val = max(max_val, block_peak)
+                    if report:
+                        report((i + 1) / total_steps)
+            else:
+                max_val = max((sum(self.renderer.peak_bound(plan, start, stop) for plan in plans)
+                               for start, stop in ranges), default=0)
+        
+        def blocks():
+            for i, ((start, stop), mixed_audio) in enumerate(zip(ranges, self.map_segments(mix_block, ranges))):
+                with self.profiler.stage('normalize', count=stop - start):
+                    if max_val > 0:
+                        block = self.renderer.to_int16(mixed_audio, max_val, self.max_amplitude)
+                    else:
+                        block = mixed_audio.astype(np.int16)
+                yield block
+                if report:
+                    report((total_steps - len(ranges) + i + 1) / total_steps)
+        
+        with self.profiler.stage('write', count=length):
+            write_wav_blocks(filename, blocks(), self.renderer.sample_rate, self.renderer.channels)
+    
+    def map_segments(self, func, ranges):
+        # 依序產生每個時間區段 func(start, stop) 的結果。
+        # render_threads > 1 時由執行緒池預先渲染後面的區段(最多 2 倍執行緒數，串流匯出的記憶體仍有上限)；
+        # 跨越區段邊界的音符尾巴由 render_block 從正確的偏移量接續，結果與循序渲染逐位元相同
+        if self.render_threads <= 1 or len(ranges) <= 1:
+            for start, stop in ranges:
+                yield func(start, stop)
+            return
+        with ThreadPoolExecutor(max_workers=self.render_threads) as pool:
+            pending = deque()
+            for start, stop in ranges:
+                pending.append(pool.submit(func, start, stop))
+                if len(pending) >= 2 * self.render_threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    
+    def preview(self, downsample=PREVIEW_DOWNSAMPLE, mono=True, tail=None):
+        # 快速預覽：共用樂譜與軌道設定，改用低取樣率(單聲道)的音色庫，音符時間與完整渲染相同；
+        # 低解析度音色庫第一次使用時建立，並快取在音色庫資料夾中
+        key = (downsample, mono)
+        if key not in self.preview_banks:
+            self.preview_banks[key] = SampleBank(self.sample_bank.notes_dir, fade_samples=self.sample_bank.fade_samples,
+                                                 downsample=downsample, mono=mono)
+        piano_gen = copy.copy(self)
+        piano_gen.sample_bank = self.preview_banks[key]
+        piano_gen.renderer = Renderer(piano_gen.sample_bank, self.renderer.precision)
+        piano_gen.tail = tail
+        return piano_gen
+    
+    async def export_preview(self, filename, downsample=PREVIEW_DOWNSAMPLE, mono=True, tail=None):
+        await self.preview(downsample, mono, tail).export_to_wav(filename)
     
     async def play_and_export(self, filename):
-        # 同時播放並匯出音樂
+        # 同時播放並匯出音樂；匯出在背景執行緒進行，播放時序不受影響
         await asyncio.gather(
             self.play_music(),
-            self.export_to_wav(filename)
+            self.export_to_wav(filename, progress=self.print_export_progress)
         )
+    
+    def print_export_progress(self, fraction):
+        print(f"匯出進度: {fraction:.0%}")
 
-def load_sheet_music(sheet_name):
-    # 動態載入樂譜模組
+def sheet_from_module(module, strict=False):
+    # 左右手樂譜回傳 (tempo, right_score, right_beat, left_score, left_beat)；
+    # 定義了 tracks(每軌一個 dict: name, score, beat, gain, pan)的多軌樂譜回傳編譯後的 CompiledScore
+    if hasattr(module, 'tracks'):
+        return compile_tracks(module.tempo, [Track(**track) for track in module.tracks], strict)
+    return (
+        module.tempo,
+        module.right_score,
+        module.right_beat,
+        module.left_score,
+        module.left_beat
+    )
+
+def load_sheet_module(path, module_name):
+    # 每次都從原始檔重新執行樂譜模組，不經過 sys.modules 與 .pyc 快取，
+    # 常駐的渲染伺服器在樂譜修改後才會讀到新的內容
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    with open(path, 'rb') as f:
+        code = compile(f.read(), path, 'exec')
+    exec(code, module.__dict__)
+    return module
+
+def load_sheet_music(sheet_name, strict=False):
+    # 動態載入 sheets 資料夾裡的樂譜模組
     try:
-        module = importlib.import_module(f'sheets.{sheet_name}')
-        return (
-            module.tempo,
-            module.right_score,
-            module.right_beat,
-            module.left_score,
-            module.left_beat
-        )
-    except ImportError as e:
+        module = load_sheet_module(os.path.join(SHEETS_DIR, f'{sheet_name}.py'), f'sheets.{sheet_name}')
+    except (OSError, ImportError) as e:
         print(f"錯誤: 無法載入樂譜 '{sheet_name}': {e}")
         return None
+    return sheet_from_module(module, strict)
+
+def create_generator(sheet_data, **kwargs):
+    # 依 load_sheet_music 的結果建立 PianoMusicGenerator
+    if isinstance(sheet_data, CompiledScore):
+        return PianoMusicGenerator.from_score(sheet_data, **kwargs)
+    return PianoMusicGenerator(*sheet_data, **kwargs)
 
 async def main():
     # 選擇樂譜
@@ -264,8 +469,10 @@ async def main():
     if not sheet_data:
         return
     
-    tempo, right_score, right_beat, left_score, left_beat = sheet_data
-    piano_gen = PianoMusicGenerator(tempo, right_score, right_beat, left_score, left_beat)
+    # 設定環境變數 PIANO_PROFILE=<檔名> 時，結束後把各階段的效能紀錄存成 JSON
+    profile_path = os.environ.get('PIANO_PROFILE')
+    profiler = Profiler() if profile_path else None
+    piano_gen = create_generator(sheet_data, profiler=profiler)
     
     # 選擇操作
     print("\n")
@@ -273,8 +480,9 @@ async def main():
     print("1. 僅播放音樂")
     print("2. 僅匯出WAV檔案")
     print("3. 播放並匯出WAV檔案")
+    print("4. 快速預覽(匯出低解析度WAV檔案)")
     
-    choice = input("輸入選擇 (1/2/3): ")
+    choice = input("輸入選擇 (1/2/3/4): ")
     
     if choice == "1":
         await piano_gen.play_music()
@@ -284,8 +492,16 @@ async def main():
     elif choice == "3":
         filename = sheet_name
         await piano_gen.play_and_export(filename)
+    elif choice == "4":
+        await piano_gen.export_preview(f'{sheet_name}_preview')
     else:
         print("無效選擇")
+        return
+    
+    if profiler:
+        profiler.stop()
+        profiler.dump(profile_path)
+        print(f"已儲存效能紀錄: {profile_path}")
 
 if platform.system() == "Emscripten":
     asyncio.ensure_future(main())
@@ -0,0 +1,118 @@
+import copy
+import heapq
+import numpy as np
+from envelope import release_curve
+
+# 軟體混音器：取代 pygame 固定的 50 個聲道，所有音符混成單一輸出串流。
+# 複音數有明確上限，超過時依策略搶走一個發聲中的音符(voice stealing)，
+# 被搶走的音符以與踏板放開相同的釋放曲線在 fade_samples 內淡出；
+# 沒有發生搶奪時，混音結果與匯出相同；播放的正規化改用不需渲染的峰值上限，
+# 音量可能比匯出的檔案略小，但第一個區塊不必等整首渲染完就能開始播放
+
+MAX_VOICES = 32
+STEAL_POLICIES = ('oldest', 'quietest')
+ENVELOPE_CHUNK = 1024  # 估計音量用的包絡線解析度(取樣點數)
+
+
+def kernel_envelopes(kernels):
+    # 每個波形每 ENVELOPE_CHUNK 個取樣點的峰值，用於找出最小聲的音符
+    envelopes = []
+    for kernel in kernels:
+        chunks = -(-len(kernel) // ENVELOPE_CHUNK)
+        padded = np.zeros((chunks * ENVELOPE_CHUNK, kernel.shape[1]), dtype=np.float64)
+        padded[:len(kernel)] = np.abs(kernel)
+        envelopes.append(padded.reshape(chunks, -1).max(axis=1))
+    return envelopes
+
+
+def allocate_voices(plans, max_voices=MAX_VOICES, steal='oldest'):
+    # 依起始時間分配聲部，回傳 (縮短延音後的渲染計畫, 被搶走的音符 [(計畫索引, 事件索引, 搶奪時間)])
+    if steal not in STEAL_POLICIES:
+        raise ValueError(f"不支援的搶奪策略: {steal}")
+    plans = [copy.copy(plan) for plan in plans]
+    for plan in plans:
+        plan.counts = plan.counts.copy()
+    envelopes = [kernel_envelopes(plan.kernels) for plan in plans] if steal == 'quietest' else None
+
+    order = sorted((int(onset), p, i) for p, plan in enumerate(plans)
+                   for i, onset in enumerate(plan.onsets.tolist()) if plan.counts[i] > 0)
+    active = []  # (結束時間, 計畫索引, 事件索引)
+    stolen = []
+    for onset, p, i in order:
+        while active and active[0][0] <= onset:
+            heapq.heappop(active)
+        if len(active) >= max_voices:
+            if steal == 'oldest':
+                victim = min(active, key=lambda voice: plans[voice[1]].onsets[voice[2]])
+            else:
+                def loudness(voice):
+                    plan = plans[voice[1]]
+                    offset = onset - int(plan.onsets[voice[2]])
+                    return envelopes[voice[1]][plan.kernel_ids[voice[2]]][offset // ENVELOPE_CHUNK]
+                victim = min(active, key=loudness)
+            active.remove(victim)
+            heapq.heapify(active)
+            _, vp, vi = victim
+            plans[vp].counts[vi] = onset - plans[vp].onsets[vi]
+            stolen.append((vp, vi, onset))
+        heapq.heappush(active, (onset + int(plans[p].counts[i]), p, i))
+    return plans, stolen
+
+
+class SoftwareMixer:
+    def __init__(self, renderer, plans, max_voices=MAX_VOICES, steal='oldest'):
+        self.renderer = renderer
+        self.fade_samples = renderer.fade_samples
+        self.source_plans = plans
+        self.original_counts = [plan.counts for plan in plans]
+        self.plans, self.stolen = allocate_voices(plans, max_voices, steal)
+        self.length = min(plan.total_samples for plan in plans)
+
+    def render(self, start, stop):
+        audio_data = self.renderer.render_tracks(self.plans, start, stop)
+        self.add_releases(audio_data, start, stop)
+        return audio_data
+
+    def add_releases(self, audio_data, start, stop):
+        # 被搶走的音符：從搶奪時間起以淡出曲線收尾，只有這些少數音符需要逐一相乘
+        fade_out = release_curve(self.fade_samples)[:, np.newaxis]
+        for p, i, at in self.stolen:
+            plan = self.plans[p]
+            onset = int(plan.onsets[i])
+            end = min(at + self.fade_samples, onset + int(self.original_counts[p][i]))
+            a, b = max(at, start), min(end, stop)
+            if a < b:
+                kernel = plan.kernels[plan.kernel_ids[i]]
+                segment = audio_data[a - start:b - start]
+                gain = fade_out[a - at:b - at]
+                release = -1 if plan.releases is None else int(plan.releases[i])
+                if 0 <= release < b:
+                    # 已經因為放開踏板在收尾的音符：兩條釋放曲線相乘
+                    gain = gain.copy()
+                    k = max(a, release)
+                    gain[k - a:] *= fade_out[k - release:b - release]
+                np.add(segment, kernel[a - onset:b - onset] * gain, out=segment, casting='unsafe')
+
+    def peak_bound(self):
+        # 不實際渲染的峰值上限：每 ENVELOPE_CHUNK 個取樣點，把發聲中音符的包絡線峰值相加
+        # (忽略相位，所以不會小於實際峰值)。以搶奪前的延音長度計算，被搶走音符的淡出尾巴也包含在內；
+        # 音符的包絡線區塊與時間軸的區塊不對齊，時間軸的每個區塊取重疊的兩個包絡線區塊中較大的
+        bound = np.zeros(-(-self.length // ENVELOPE_CHUNK) + 1)
+        for plan, counts in zip(self.source_plans, self.original_counts):
+            envelopes = kernel_envelopes(plan.kernels)
+            for onset, kernel_id, count in zip(plan.onsets.tolist(), plan.kernel_ids.tolist(),
+                                               np.minimum(counts, self.length - plan.onsets).tolist()):
+                if count <= 0:
+                    continue
+                envelope = envelopes[kernel_id][:-(-count // ENVELOPE_CHUNK)]
+                first = onset // ENVELOPE_CHUNK
+                if onset % ENVELOPE_CHUNK:
+                    envelope = np.maximum(np.append(envelope, 0.0), np.insert(envelope, 0, 0.0))
+                bound[first:first + len(envelope)] += envelope
+        return float(bound.max()) if len(bound) else 0.0
+
+    def render_int16(self, start, stop, max_val, max_amplitude):
+        audio_data = self.render(start, stop)
+        if max_val > 0:
+            return self.renderer.to_int16(audio_data, max_val, max_amplitude)
+        return audio_data.astype(np.int16)
@@ -0,0 +1,162 @@
+import json
+import time
+import threading
+import tracemalloc
+import numpy as np
+
+# 各階段的效能紀錄：牆鐘時間、配置的記憶體(峰值增量)與計數，播放時另有延遲直方圖
+# (pygame 聲道播放記錄每個音符的觸發延遲，軟體混音播放記錄每個 0.25 秒區塊排入佇列的延遲)
+# 用法：
+#   profiler = Profiler()
+#   piano_gen = PianoMusicGenerator(..., profiler=profiler)
+#   piano_gen.write_wav('out.wav')
+#   profiler.report()  或  profiler.dump('profile.json')
+# 沒有指定 profiler 時使用 NULL_PROFILER，每個階段只多一次方法呼叫
+# 階段可以巢狀(例如串流匯出的 write 包含每個區塊的 render)，外層的時間與記憶體包含內層
+# 平行渲染時各執行緒有自己的巢狀堆疊；記憶體峰值是整個行程的，多執行緒時只是近似值
+
+LATENESS_BINS = [0, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, float('inf')]  # 延遲直方圖的邊界(秒)
+
+
+class _Stage:
+    def __init__(self, profiler, name, count):
+        self.profiler = profiler
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.profiler._enter()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.profiler._exit(self.name, seconds, self.count)
+        return False
+
+
+class _NullStage:
+    count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+    def __init__(self, memory=True):
+        self.memory = memory    # 以 tracemalloc 量測每個階段配置的記憶體(會讓執行變慢)
+        self.stages = {}        # 階段名稱 -> {'calls', 'seconds', 'bytes', 'count'}
+        self.counters = {}      # 名稱 -> 次數(例如 dropped_channels)
+        self.lateness = []      # 聲道播放時每個音符的 (聲部, 延遲秒數)
+        self.block_lateness = []  # 軟體混音播放時每個區塊的 ('block', 延遲秒數)
+        self.hooks = []         # 每個階段結束時呼叫 hook(名稱, 這次的紀錄 dict)
+        self._local = threading.local()  # 每個執行緒自己的記憶體堆疊
+        self._lock = threading.Lock()
+        self._started_tracing = memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def stage(self, name, count=0):
+        # with profiler.stage('render', count=音符數) as stage: ...，count 也可以在區塊內設定
+        return _Stage(self, name, count)
+
+    @property
+    def _memory_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _enter(self):
+        if not self.memory:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._memory_stack
+        for frame in stack:
+            frame[1] = max(frame[1], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+
+    def _exit(self, name, seconds, count):
+        allocated = 0
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            stack = self._memory_stack
+            start, frame_peak = stack.pop()
+            frame_peak = max(frame_peak, peak)
+            allocated = frame_peak - start
+            if stack:
+                stack[-1][1] = max(stack[-1][1], frame_peak)
+
+        with self._lock:
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'count': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] = max(stats['bytes'], allocated)
+            stats['count'] += count
+        record = {'seconds': seconds, 'bytes': allocated, 'count': count}
+        for hook in self.hooks:
+            hook(name, record)
+
+    def stop(self):
+        # 停止由這個 profiler 啟動的 tracemalloc(追蹤期間所有配置都會變慢)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+            self.memory = False
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_lateness(self, lateness, blocks=False):
+        (self.block_lateness if blocks else self.lateness).extend(lateness)
+
+    def lateness_histogram(self, blocks=False):
+        late = np.array([seconds for _, seconds in (self.block_lateness if blocks else self.lateness)])
+        counts, _ = np.histogram(late, bins=LATENESS_BINS)
+        summary = {
+            'bins': LATENESS_BINS[:-1],
+            'counts': counts.tolist(),
+            'blocks' if blocks else 'notes': len(late),
+        }
+        if len(late):
+            summary.update(mean=float(late.mean()), p99=float(np.percentile(late, 99)), max=float(late.max()))
+        return summary
+
+    def report(self):
+        return {
+            'stages': self.stages,
+            'counters': self.counters,
+            'lateness': self.lateness_histogram(),
+            'block_lateness': self.lateness_histogram(blocks=True),
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullProfiler:
+    # 關閉時的替身：不計時、不量測記憶體
+    memory = False
+    hooks = []
+
+    def stage(self, name, count=0):
+        return _NULL_STAGE
+
+    def add(self, name, value=1):
+        pass
+
+    def record_lateness(self, lateness, blocks=False):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
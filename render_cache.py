@@ -0,0 +1,103 @@
+import os
+import hashlib
+import tempfile
+import threading
+import numpy as np
+
+# 區段層級的渲染快取：逐區段混音(切點在小節邊界)時，每個區段所有軌道的混音結果依內容雜湊存到磁碟，
+# 修改樂譜中的某一小節後，只有內容改變的區段(該小節與音符尾巴延伸到的區段)需要重新渲染
+# 快取以混音精度原樣儲存，結果與不使用快取逐位元相同
+
+
+class MeasureCache:
+    def __init__(self, cache_dir='.render_cache', max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes  # 磁碟用量上限，超過時刪除最久沒用到的小節
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # 多個執行緒同時渲染區段時保護用量統計與清除
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir)
+                                if entry.name.endswith('.npy'))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            audio_data = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # 更新修改時間，作為 LRU 依據
+        except OSError:
+            pass  # 剛好被清除：已載入的內容仍然可用
+        with self._lock:
+            self.hits += 1
+        return audio_data
+
+    def put(self, key, audio_data):
+        # 先寫到唯一的暫存檔再改名：同一首曲子中內容相同的區段可能同時寫入同一個鍵
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, audio_data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._total_bytes += os.path.getsize(path)
+            self._evict()
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy')),
+                         key=lambda entry: entry.stat().st_mtime_ns)
+        self._total_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._total_bytes -= size
+
+
+def measure_ranges(plan):
+    # 依 current_measure_beats 的四拍計算切出的小節範圍 [(起點, 終點), ...]
+    bounds = [0] + [pos for pos in plan.fade_positions.tolist() if 0 < pos < plan.total_samples]
+    bounds.append(plan.total_samples)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+
+
+def segment_key(plans, start, stop, version):
+    # 區段內容的雜湊：區段長度、音色庫版本與混音精度，以及每一軌在區段內發聲的事件
+    # (相對起始位置、音符、音量、實際延音長度、放開踏板的收尾位置)、左右平衡與區段內的踏板釋放區間
+    digest = hashlib.sha1(f'{version}-{stop - start}'.encode('utf-8'))
+    for plan in plans:
+        lo, hi = plan.active_range(start, stop)
+        onsets = plan.onsets[lo:hi]
+        counts = plan.counts[lo:hi]
+        live = (onsets + counts > start) & (counts > 0)
+        windows = np.array(list(plan.envelope.windows(start, stop)), dtype=np.int64).reshape(-1, 2)
+        digest.update(np.array([live.sum(), len(windows), plan.releases is not None],
+                               dtype=np.int64).tobytes())  # 軌道之間的分界
+        digest.update(np.float64(plan.pan).tobytes())
+        digest.update((onsets[live] - start).tobytes())
+        digest.update(plan.notes[lo:hi][live].tobytes())
+        digest.update(plan.gains[lo:hi][live].tobytes())
+        digest.update(counts[live].tobytes())
+        if plan.releases is not None:
+            releases = plan.releases[lo:hi][live]
+            digest.update(np.where(releases >= 0, releases - start, np.iinfo(np.int64).min).tobytes())
+        digest.update((windows - start).tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 常駐的渲染伺服器：音色庫只載入一次並常駐記憶體，透過 Unix socket 接收工作，
+# 工作排入佇列後由執行緒池渲染，並即時回傳進度與輸出檔名
+#
+# 通訊協定：每行一個 JSON
+#   工作： {"sheet": "river"} 或 {"score": "sheets/river.score"}，
+#          可選 "output", "stream", "precision", "preview", "tail"
+#   回應： {"job": 1, "status": "queued", "position": 1}
+#          {"job": 1, "status": "running"}
+#          {"job": 1, "status": "progress", "progress": 0.5}
+#          {"job": 1, "status": "done", "path": "/.../river.wav", "seconds": 0.05}
+#          {"job": 1, "status": "error", "error": "..."}
+# 用法：
+#   python3 render_server.py serve -j 2
+#   python3 render_server.py render river -o river.wav
+# 用戶端不載入 NumPy/音色庫，送出工作幾乎沒有啟動成本
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'piano_render.sock')
+
+
+def send(writer, message):
+    if not writer.is_closing():
+        writer.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+
+
+class RenderServer:
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=2, notes_dir='notes', output_dir='.', cache_dir=None):
+        from notes import note_to_name
+        from sample_bank import SampleBank
+        from render_cache import MeasureCache
+        self.socket_path = socket_path
+        self.workers = workers
+        self.output_dir = output_dir
+        # 啟動時解碼所有音符，之後工作之間只會讀取音色庫
+        self.sample_bank = SampleBank(notes_dir)
+        self.sample_bank.preload(note_to_name.values())
+        self.render_cache = MeasureCache(cache_dir) if cache_dir else None
+        self.preview_banks = {}  # 預覽用音色庫也在工作之間共用
+        self.preview_lock = threading.Lock()  # 同時有多個預覽工作時只建立一次預覽用音色庫
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = None
+        self._job_ids = itertools.count(1)
+
+    def render(self, job, report=None):
+        # 在執行緒池中渲染一個工作，回傳輸出檔名
+        from main import create_generator
+        from batch import load_sheet
+        source = job.get('score') or job.get('sheet')
+        if not source:
+            raise ValueError("工作需要指定 sheet 或 score")
+        sheet_data = load_sheet(source)
+        if not sheet_data:
+            raise ValueError(f"無法載入樂譜 '{source}'")
+
+        piano_gen = create_generator(sheet_data, sample_bank=self.sample_bank, render_cache=self.render_cache,
+                                     precision=job.get('precision', 'float64'))
+        piano_gen.preview_banks = self.preview_banks
+        # 同時執行的工作平分 CPU 核心，單一工作時整首平行分段渲染
+        piano_gen.render_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        name = os.path.splitext(os.path.basename(source))[0]
+        if job.get('preview'):
+            with self.preview_lock:
+                piano_gen = piano_gen.preview(tail=job.get('tail'))
+            name += '_preview'
+        filename = os.path.join(self.output_dir, job.get('output') or f'{name}.wav')
+        piano_gen.write_wav(filename, stream=job.get('stream', False), report=report)
+        return os.path.abspath(filename)
+
+    async def handle_client(self, reader, writer):
+        async for line in reader:
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("工作必須是 JSON 物件")
+            except ValueError as e:
+                send(writer, {'status': 'error', 'error': f"無效的工作: {e}"})
+                continue
+            job_id = next(self._job_ids)
+            self.queue.put_nowait((job_id, job, writer))
+            send(writer, {'job': job_id, 'status': 'queued', 'position': self.queue.qsize()})
+            await writer.drain()
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id, job, writer = await self.queue.get()
+            send(writer, {'job': job_id, 'status': 'running'})
+            report = lambda fraction: loop.call_soon_threadsafe(
+                send, writer, {'job': job_id, 'status': 'progress', 'progress': fraction})
+            start = time.perf_counter()
+            try:
+                path = await loop.run_in_executor(self.executor, self.render, job, report)
+                message = {'job': job_id, 'status': 'done', 'path': path, 'seconds': time.perf_counter() - start}
+            except Exception as e:
+                message = {'job': job_id, 'status': 'error', 'error': str(e)}
+            send(writer, message)
+            print(f"工作 {job_id} {message['status']}: {message.get('path') or message.get('error')}")
+            self.queue.task_done()
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        print(f"渲染伺服器已啟動: {self.socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+async def submit(job, socket_path=DEFAULT_SOCKET, progress=None):
+    # 送出一個工作並等待完成，回傳最後的 done/error 訊息；progress(訊息) 會收到中間的狀態
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        send(writer, job)
+        await writer.drain()
+        async for line in reader:
+            message = json.loads(line)
+            if message['status'] in ('done', 'error'):
+                return message
+            if progress:
+                progress(message)
+        return {'status': 'error', 'error': "伺服器中斷連線"}
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+def render(job, socket_path=DEFAULT_SOCKET, progress=None):
+    return asyncio.run(submit(job, socket_path, progress))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="常駐渲染伺服器")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Unix socket 路徑")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help="啟動伺服器")
+    serve.add_argument('-j', '--jobs', type=int, default=2, help="同時渲染的工作數")
+    serve.add_argument('-o', '--output', default='.', help="預設的輸出資料夾")
+    serve.add_argument('--notes', default='notes', help="音色庫資料夾")
+    serve.add_argument('--cache', help="區段渲染快取資料夾")
+
+    client = commands.add_parser('render', help="送出渲染工作")
+    client.add_argument('sheet', help="樂譜名稱、樂譜模組路徑或編譯後的樂譜(.score)")
+    client.add_argument('-o', '--output', help="輸出的 WAV 檔名")
+    client.add_argument('--stream', action='store_true', help="使用串流匯出")
+    client.add_argument('--precision', choices=['float64', 'float32', 'int32'], default='float64')
+    client.add_argument('--preview', action='store_true', help="快速預覽(11025 Hz 單聲道)")
+    client.add_argument('--tail', type=float, help="預覽時音符尾巴最長秒數")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = RenderServer(args.socket, args.jobs, args.notes, args.output, args.cache)
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    # 路徑以用戶端的工作目錄為準
+    source = args.sheet
+    if source.endswith(('.py', '.score')):
+        source = os.path.abspath(source)
+    job = {'score' if source.endswith('.score') else 'sheet': source, 'stream': args.stream,
+           'precision': args.precision, 'preview': args.preview, 'tail': args.tail}
+    if args.output:
+        job['output'] = os.path.abspath(args.output)
+
+    def print_progress(message):
+        if message['status'] == 'progress':
+            print(f"進度: {message['progress']:.0%}")
+
+    start = time.perf_counter()
+    try:
+        message = render(job, args.socket, print_progress)
+    except OSError as e:
+        print(f"錯誤: 無法連線到渲染伺服器 {args.socket}: {e}")
+        return 1
+    if message['status'] == 'error':
+        print(f"錯誤: {message['error']}")
+        return 1
+    print(f"已完成: {message['path']}(伺服器 {message['seconds']:.3f} 秒，總共 {time.perf_counter() - start:.3f} 秒)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import wave
+import numpy as np
+from notes import note_to_name
+from sample_bank import SAMPLE_RATE
+from score import compile_part
+from render_cache import measure_ranges, segment_key
+from envelope import Envelope, release_curve
+
+BLOCK_SIZE = 65536  # 串流渲染的區塊大小(取樣點數)
+MIX_DTYPES = {'float64': np.float64, 'float32': np.float32, 'int32': np.int32}
+FIXED_SHIFT = 3  # int32 定點數：波形放大 8 倍後取整數
+INT32_SAFE = (1 << 30) - 1  # 單一聲部的安全上限，兩個聲部相加也不會溢位
+INT32_MAX = np.iinfo(np.int32).max
+
+# 事件表：每個發聲的音符一筆(和弦會攤平成多筆)，依樂譜順序排列
+EVENT_DTYPE = np.dtype([
+    ('onset', np.int64),    # 起始取樣點
+    ('note', np.int16),     # 音符數字
+    ('gain', np.float64),   # 音量
+    ('length', np.int64),   # 延音長度(取樣點數，踏板最多延長一個小節)
+])
+
+
+def pan_gains(pan):
+    # 左右聲道增益：置中時兩邊都是 1(與沒有平衡時逐位元相同)，往一邊移動時只降低另一邊
+    return np.array([min(1.0, 1.0 - pan), min(1.0, 1.0 + pan)])
+
+
+def compile_events(score, beat, tempo, volume, sample_rate=SAMPLE_RATE):
+    # 把 score/beat 編譯成事件表，回傳 (事件表, 總取樣點數, 每小節結尾的淡出位置)
+    part, total_beats = compile_part(score, beat, warn=False)
+    return events_from_part(part, total_beats, tempo, volume, sample_rate)
+
+
+def events_from_part(part, total_beats, tempo, volume, sample_rate=SAMPLE_RATE):
+    # 由編譯後的樂譜(一個聲部)直接計算事件表，不需逐音符的 Python 迴圈；
+    # 每一步的取樣點數與原本一樣先各自取整數再累加，時間點完全一致
+    quarter_duration = 60 / tempo
+    measure_duration = 4 * quarter_duration
+    total_samples = int(total_beats * quarter_duration * sample_rate)
+    measure_samples = int(measure_duration * sample_rate)
+
+    steps, step_index = np.unique(part['step'], return_index=True)
+    step_rows = part[step_index]
+    duration_samples = (step_rows['duration'] * quarter_duration * sample_rate).astype(np.int64)
+    step_ends = np.cumsum(duration_samples)
+    step_starts = step_ends - duration_samples
+    sustain_samples = np.clip(total_samples - step_starts, 0, measure_samples)
+
+    row_steps = np.searchsorted(steps, part['step'])
+    sounding = part['note'] != 0
+    events = np.zeros(int(sounding.sum()), dtype=EVENT_DTYPE)
+    events['onset'] = step_starts[row_steps[sounding]]
+    events['note'] = part['note'][sounding]
+    events['gain'] = volume
+    events['length'] = sustain_samples[row_steps[sounding]]
+    return events, total_samples, step_ends[step_rows['bar_end']]
+
+
+def segment_ranges(plan, length, size=BLOCK_SIZE):
+    # 把 [0, length) 切成大約 size 長的區段，切點取在小節邊界；
+    # 太長的一段(沒有小節邊界)以 size 直接切開，避免暫存區過大
+    cuts = []
+    last = 0
+    for pos in [stop for _, stop in measure_ranges(plan)] + [length]:
+        pos = min(pos, length)
+        while pos - last > 2 * size:
+            last += size
+            cuts.append(last)
+        if pos - last >= size or pos == length:
+            cuts.append(pos)
+            last = pos
+    bounds = [0] + sorted(set(cuts))
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if start < stop]
+
+
+class RenderPlan:
+    # 一個聲部的渲染計畫：已乘上音量的波形以及每個事件實際要疊加的長度
+    def __init__(self, events, kernels, kernel_ids, counts, total_samples, fade_positions, pan=0.0, envelope=None,
+                 releases=None):
+        self.kernels = kernels
+        self.kernel_ids = kernel_ids
+        self.onsets = events['onset']
+        self.notes = events['note']
+        self.gains = events['gain']
+        self.counts = counts
+        self.total_samples = total_samples
+        self.fade_positions = fade_positions
+        self.pan = pan
+        self.envelope = envelope  # 踏板時間軸與小節淡出的增益曲線(envelope.Envelope)
+        self.releases = releases  # 每個事件因放開踏板開始收尾的位置(-1 表示沒有)，None 表示都沒有
+        self.max_count = int(counts.max()) if len(counts) else 0
+        self.kernel_peaks = np.array([np.abs(k).max() if len(k) else 0.0 for k in kernels])
+
+    def active_range(self, start, stop):
+        # 與 [start, stop) 重疊的事件索引範圍(onset 依樂譜順序遞增)
+        lo = np.searchsorted(self.onsets, start - self.max_count, 'right')
+        hi = np.searchsorted(self.onsets, stop, 'left')
+        return int(lo), int(hi)
+
+
+class Renderer:
+    # 向量化的混音引擎：先依 (音符, 音量) 分組批次建立已乘上音量的波形，
+    # 再依樂譜順序把波形疊加到輸出，熱迴圈內不產生任何暫存陣列
+    # 疊加本身受記憶體頻寬限制(river 約 840 個事件、1.5 億次加法，迴圈本身只佔約 1%)；
+    # 同一個波形的事件合併成一次疊加會改變每個取樣點的加總順序，float64 就不再逐位元一致，
+    # 所以疊加仍是逐事件的切片相加
+    #
+    # precision 決定混音匯流排的型別：
+    #   'float64' 參考實作，結果與原本逐音符迴圈逐位元一致
+    #   'float32' 記憶體與頻寬減半；K 個重疊音符的累加相對誤差 <= K * 2^-24，
+    #             正規化成 16-bit 後與 float64 最多差 1 LSB
+    #   'int32'   定點數累加(放大 2^FIXED_SHIFT 倍)；每個音符量化誤差 <= 2^-(FIXED_SHIFT+1) 個原始 LSB，
+    #             K 個重疊音符最多 K * 2^-(FIXED_SHIFT+1) LSB(正規化前)；
+    #             可能超出 ±INT32_SAFE 的區塊改用 int64 累加後飽和裁切
+    def __init__(self, sample_bank, precision='float64'):
+        if precision not in MIX_DTYPES:
+            raise ValueError(f"不支援的混音精度: {precision}")
+        self.sample_bank = sample_bank
+        # 預覽用的低解析度音色庫：取樣率、聲道數與淡出長度都跟著音色庫
+        self.downsample = sample_bank.downsample
+        self.sample_rate = sample_bank.sample_rate
+        self.channels = sample_bank.channels
+        self.fade_samples = sample_bank.fade_samples // self.downsample
+        self.precision = precision
+        self.dtype = MIX_DTYPES[precision]
+        self.saturated_blocks = 0  # int32 模式中發生飽和裁切的區塊數
+
+    def build_kernels(self, events, pan=0.0):
+        # 每個不同的 (音符, 音量) 只計算一次波形；左右平衡直接乘進波形
+        keys, kernel_ids = np.unique(events[['note', 'gain']], return_inverse=True)
+        channel_gains = pan_gains(pan) if self.channels == 2 else np.ones(1)
+        if self.precision == 'int32':
+            channel_gains = channel_gains * (1 << FIXED_SHIFT)
+        kernels = []
+        for note, gain in keys.tolist():
+            frames = self.sample_bank.get(note_to_name[int(note)])
+            # 增益先轉成波形的型別，置中時與乘上單一純量的結果逐位元相同
+            kernel = frames * (gain * channel_gains).astype(frames.dtype)
+            kernels.append(np.rint(kernel).astype(np.int32) if self.precision == 'int32' else kernel)
+        return kernels, kernel_ids.reshape(-1)
+
+    def plan(self, events, total_samples, fade_positions, pan=0.0, tail=None, pedal=None):
+        # 事件時間以 SAMPLE_RATE 計算；低取樣率的音色庫(預覽)把每個時間點直接除以 downsample，
+        # 不重新累加每一步的長度，所以音符時間與完整渲染相同(誤差小於一個預覽取樣點，不會累積)
+        # tail：音符尾巴最長秒數(預覽用)，None 表示不截短
+        # pedal：樂譜指定的踏板時間軸(envelope.PEDAL_DTYPE)，None 表示每小節踩一次
+        if self.downsample > 1 or tail is not None:
+            events = events.copy()
+            events['onset'] //= self.downsample
+            events['length'] //= self.downsample
+            total_samples //= self.downsample
+            fade_positions = fade_positions // self.downsample
+            if pedal is not None:
+                pedal = pedal.copy()
+                pedal['position'] //= self.downsample
+            if tail is not None:
+                events['length'] = np.minimum(events['length'], int(tail * self.sample_rate))
+        if len(events):
+            kernels, kernel_ids = self.build_kernels(events, pan)
+            kernel_lengths = np.array([len(k) for k in kernels], dtype=np.int64)
+            # 實際疊加長度：延音長度與音色長度取小者，並限制在曲長之內
+            onsets = events['onset']
+            counts = np.minimum(np.minimum(events['length'], kernel_lengths[kernel_ids]),
+                                total_samples - onsets)
+            counts = np.maximum(counts, 0)
+        else:
+            kernels, kernel_ids = [], np.zeros(0, dtype=np.intp)
+            counts = np.zeros(0, dtype=np.int64)
+        if pedal is None:
+            envelope = Envelope.from_measures(fade_positions, self.fade_samples)
+        else:
+            envelope = Envelope(pedal, self.fade_samples)
+        releases, counts = envelope.damp(events['onset'], counts)
+        if not (releases >= 0).any():
+            releases = None
+        return RenderPlan(events, kernels, kernel_ids, counts, total_samples, fade_positions, pan, envelope, releases)
+
+    def render_block(self, plan, start, stop):
+        # 只渲染 [start, stop) 這一段；跨越區塊邊界的音符尾巴會從正確的偏移量接續，
+        # 每個取樣點的疊加順序與整首渲染相同，因此結果逐位元一致
+        lo, hi = plan.active_range(start, stop)
+        audio_data = self.mix_events(plan, lo, hi, start, stop)
+        return plan.envelope.apply(audio_data, start)
+
+    def render_tracks(self, plans, start, stop, out=None):
+        # 多軌混音：每一軌只需要一個區塊大小的暫存，依序加進同一個輸出緩衝區，
+        # 記憶體用量與軌數無關；加總順序與逐軌整首渲染後相加相同
+        if out is None:
+            out = np.zeros((stop - start, self.channels), dtype=self.dtype)
+        if self.dtype == np.int32 and sum(self.peak_bound(plan, start, stop) for plan in plans) > INT32_MAX:
+            # 軌數多時 int32 可能溢位：這個區塊改用 int64 加總後飽和裁切
+            self.saturated_blocks += 1
+            mixed = out.astype(np.int64)
+            for plan in plans:
+                mixed += self.render_block(plan, start, stop)
+            out[:] = np.clip(mixed, -INT32_MAX, INT32_MAX)
+            return out
+        for plan in plans:
+            out += self.render_block(plan, start, stop)
+        return out
+
+    def mix_events(self, plan, lo, hi, start, stop):
+        # 把第 lo~hi 個事件落在 [start, stop) 的部分疊加起來(不含小節淡出)
+        dtype = self.dtype
+        if dtype == np.int32 and self._peak_sum(plan, lo, hi, start) > INT32_SAFE:
+            dtype = np.int64
+        audio_data = np.zeros((stop - start, self.channels), dtype=dtype)
+        kernels = plan.kernels
+        for onset, kernel_id, count in zip(plan.onsets[lo:hi].tolist(),
+                                           plan.kernel_ids[lo:hi].tolist(),
+                                           plan.counts[lo:hi].tolist()):
+            a = max(onset, start)
+            b = min(onset + count, stop)
+            if a < b:
+                audio_data[a - start:b - start] += kernels[kernel_id][a - onset:b - onset]
+        if plan.releases is not None:
+            self.damp_events(plan, lo, hi, start, stop, audio_data)
+
+        if dtype != self.dtype:
+            # 飽和保護：超出安全範圍的取樣點直接裁切
+            self.saturated_blocks += 1
+            audio_data = np.clip(audio_data, -INT32_SAFE, INT32_SAFE).astype(self.dtype)
+        return audio_data
+
+    def damp_events(self, plan, lo, hi, start, stop, audio_data):
+        # 放開踏板的收尾：上面已疊加整段延音，這裡只把收尾部分乘上(釋放曲線 - 1)補回差值，
+        # 只有被踏板收尾的少數音符需要逐一相乘
+        damping = release_curve(self.fade_samples)[:, np.newaxis] - 1
+        releases = plan.releases[lo:hi]
+        for i in (np.flatnonzero(releases >= 0) + lo).tolist():
+            onset = int(plan.onsets[i])
+            release = int(plan.releases[i])
+            a = max(release, start)
+            b = min(onset + int(plan.counts[i]), stop)
+            if a < b:
+                kernel = plan.kernels[plan.kernel_ids[i]]
+                segment = audio_data[a - start:b - start]
+                tail = kernel[a - onset:b - onset] * damping[a - release:b - release]
+                if segment.dtype.kind == 'i':
+                    tail = np.rint(tail)
+                np.add(segment, tail, out=segment, casting='unsafe')
+
+    def render_tracks_cached(self, plans, start, stop, cache, out=None):
+        # 使用區段快取的 render_tracks：命中時直接讀取整個區段的混音結果，不需疊加任何音符；
+        # 區段從 out 為零開始加總，快取結果加進 out 與直接渲染進 out 逐位元相同
+        key = segment_key(plans, start, stop, f'{self.sample_bank.version}-{self.precision}')
+        mixed = cache.get(key)
+        if mixed is None:
+            mixed = self.render_tracks(plans, start, stop)
+            cache.put(key, mixed)
+        if out is None:
+            return np.array(mixed, dtype=self.dtype)
+        out += mixed
+        return out
+
+    def peak_bound(self, plan, start, stop):
+        # 不實際渲染的峰值上限：重疊事件的波形峰值總和
+        lo, hi = plan.active_range(start, stop)
+        return self._peak_sum(plan, lo, hi, start)
+
+    def _peak_sum(self, plan, lo, hi, start):
+        ends = plan.onsets[lo:hi] + plan.counts[lo:hi]
+        active = (ends > start) & (plan.counts[lo:hi] > 0)
+        return float(plan.kernel_peaks[plan.kernel_ids[lo:hi][active]].sum())
+
+    def to_int16(self, audio_data, max_val, max_amplitude):
+        # 正規化成 16-bit；float64 維持原本的運算順序，其他精度以 float32 計算以節省記憶體
+        if self.precision == 'float64':
+            return (audio_data / max_val * max_amplitude).astype(np.int16)
+        return np.multiply(audio_data, np.float32(max_amplitude / max_val), dtype=np.float32).astype(np.int16)
+
+
+def write_wav_blocks(filename, blocks, sample_rate=SAMPLE_RATE, channels=2):
+    # 逐區塊寫入 16-bit WAV，不需要把整首曲子放在記憶體裡
+    with wave.open(filename, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for block in blocks:
+            f.writeframes(np.ascontiguousarray(block, dtype='<i2').tobytes())
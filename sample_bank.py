@@ -0,0 +1,443 @@
+import os
+import json
+import shutil
+import tempfile
+import hashlib
+import struct
+import argparse
+import warnings
+from collections import OrderedDict
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+from notes import note_to_name
+from envelope import attack_curve
+
+warnings.filterwarnings("ignore", category=wavfile.WavFileWarning)
+
+SAMPLE_RATE = 44100  # WAV 檔案的取樣率
+FADE_SAMPLES = int(0.05 * SAMPLE_RATE)  # 50ms 淡入時間
+
+# 預編譯音色庫檔案格式：
+#   magic(8) + 標頭長度(uint32) + JSON 標頭 + 對齊到 64 位元組 + float32 立體聲資料
+# 標頭內含每個音符的 [起始frame, frame數] 以及來源 WAV 的大小/修改時間，用於自動失效
+COMPILED_MAGIC = b'PNOBANK1'
+COMPILED_NAME = 'compiled.bank'
+PREVIEW_DOWNSAMPLE = 4  # 預覽用音色庫：取樣率 44100 / 4 = 11025
+
+# 稀疏音色庫：只保留每 N 個鍵的錄音，缺少的鍵由最近的錄音移調合成
+MAX_SHIFT = 12  # 最多移調的半音數，超過時該音符無聲
+name_to_note = {name: note for note, name in note_to_name.items()}
+
+
+def prepare_frames(wav_data, fade_samples=FADE_SAMPLES):
+    # 轉成可直接混音的 float32 立體聲資料，並預先套用淡入
+    if wav_data.ndim == 1:  # 單聲道轉立體聲
+        wav_data = np.column_stack((wav_data, wav_data))
+    frames = wav_data.astype(np.float32)
+    head = min(fade_samples, len(frames))
+    frames[:head] = wav_data[:head] * attack_curve(fade_samples)[:head]
+    return frames
+
+
+def reduce_frames(frames, downsample=1, mono=False):
+    # 預覽用：左右聲道平均成單聲道，並以抗混疊濾波降低取樣率
+    if downsample == 1 and not mono:
+        return frames
+    if mono:
+        frames = frames.mean(axis=1, keepdims=True)
+    if downsample > 1:
+        frames = resample_poly(frames, 1, downsample, axis=0)
+    return frames.astype(np.float32)
+
+
+def pitch_shift(wav_data, semitones):
+    # 以線性內插重新取樣移調：播放速度變成 2^(semitones/12) 倍，長度也隨之改變
+    ratio = 2 ** (semitones / 12)
+    positions = np.arange(int(len(wav_data) / ratio)) * ratio
+    source = np.arange(len(wav_data))
+    if wav_data.ndim == 1:
+        return np.interp(positions, source, wav_data)
+    return np.column_stack([np.interp(positions, source, wav_data[:, c]) for c in range(wav_data.shape[1])])
+
+
+def _source_stats(notes_dir):
+    # 來源 WAV 的 [大小, 修改時間]，任何變動都會讓預編譯檔失效
+    stats = {}
+    names = set(note_to_name.values())
+    with os.scandir(notes_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.wav') and entry.name[:-4] in names:
+                st = entry.stat()
+                stats[entry.name[:-4]] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def _data_offset(header_len):
+    return -(-(len(COMPILED_MAGIC) + 4 + header_len) // 64) * 64
+
+
+def compiled_path(notes_dir='notes', downsample=1, mono=False):
+    if downsample == 1 and not mono:
+        return os.path.join(notes_dir, COMPILED_NAME)
+    return os.path.join(notes_dir, f'preview-{downsample}{"m" if mono else "s"}.bank')
+
+
+def compile_samples(notes_dir='notes', cache_path=None, fade_samples=FADE_SAMPLES, downsample=1, mono=False):
+    # 一次性把整個音色庫編譯成單一可記憶體映射的檔案；downsample/mono 為預覽用的低解析度版本
+    cache_path = cache_path or compiled_path(notes_dir, downsample, mono)
+    sources = _source_stats(notes_dir)
+    names = sorted(sources)
+
+    index = {}
+    frames_list = []
+    offset = 0
+    for name in names:
+        _, wav_data = wavfile.read(os.path.join(notes_dir, f'{name}.wav'))
+        frames = reduce_frames(prepare_frames(wav_data, fade_samples), downsample, mono)
+        index[name] = [offset, len(frames)]
+        offset += len(frames)
+        frames_list.append(frames)
+
+    header = json.dumps({
+        'sample_rate': SAMPLE_RATE,
+        'fade_samples': fade_samples,
+        'downsample': downsample,
+        'channels': 1 if mono else 2,
+        'total_frames': offset,
+        'index': index,
+        'sources': sources,
+    }).encode('utf-8')
+
+    # 先寫入唯一的暫存檔再替換，避免其他行程讀到寫到一半的檔案；
+    # 多個行程/執行緒同時編譯時各自寫自己的暫存檔，最後一個替換的為準(內容相同)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(COMPILED_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(b'\0' * (_data_offset(len(header)) - f.tell()))
+            for frames in frames_list:
+                f.write(frames.tobytes())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return cache_path
+
+
+def load_compiled(notes_dir='notes', cache_path=None, fade_samples=FADE_SAMPLES, downsample=1, mono=False):
+    # 讀取預編譯檔；檔案不存在、格式不符或來源 WAV 有變動時回傳 None
+    cache_path = cache_path or compiled_path(notes_dir, downsample, mono)
+    try:
+        with open(cache_path, 'rb') as f:
+            if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+                return None
+            (header_len,) = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_len))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    if header['sample_rate'] != SAMPLE_RATE or header['fade_samples'] != fade_samples:
+        return None
+    channels = 1 if mono else 2
+    if header.get('downsample', 1) != downsample or header.get('channels', 2) != channels:
+        return None
+    if header['sources'] != _source_stats(notes_dir):
+        return None
+
+    data = np.memmap(cache_path, dtype=np.float32, mode='r', offset=_data_offset(header_len),
+                     shape=(header['total_frames'], channels))
+    return data, header['index']
+
+
+class SampleBank:
+    # 依需求載入的音色庫：只載入樂譜用到的音符，每個檔案只解碼一次，
+    # 播放(pygame Sound)與匯出(numpy 陣列)共用同一份可直接混音的資料
+    def __init__(self, notes_dir='notes', max_bytes=None,
+                 fade_samples=FADE_SAMPLES, use_compiled=True, downsample=1, mono=False):
+        self.notes_dir = notes_dir
+        self.max_bytes = max_bytes      # 常駐記憶體上限(位元組)，None 表示不限制
+        self.fade_samples = fade_samples
+        self.downsample = downsample    # 預覽用：取樣率降為 SAMPLE_RATE // downsample
+        self.mono = mono                # 預覽用：單聲道
+        self.sample_rate = SAMPLE_RATE // downsample
+        self.channels = 1 if mono else 2
+        self.resident_bytes = 0
+        self._samples = OrderedDict()   # LRU：音符名稱 -> 預先淡入的 float32 立體聲資料
+        self._sounds = {}               # 音符名稱 -> pygame Sound
+        self.missing = set()            # 找不到檔案的音符
+        self.synthesized = set()        # 由相鄰錄音移調合成的音符(稀疏音色庫)
+        self._recorded = None
+        self._version = None
+        self._shared = None             # 共享記憶體(publish_shared/attach_shared)，需保留參考避免被釋放
+
+        # 預編譯音色庫：存在但已過期時自動重新編譯；預覽用的低解析度版本第一次使用時建立
+        self._compiled = None
+        preview = downsample > 1 or mono
+        exists = os.path.exists(compiled_path(notes_dir, downsample, mono))
+        if use_compiled and (exists or preview):
+            self._compiled = load_compiled(notes_dir, fade_samples=fade_samples, downsample=downsample, mono=mono)
+            if self._compiled is None:
+                print("音色庫已變更，重新編譯中..." if exists else "建立預覽用音色庫...")
+                compile_samples(notes_dir, fade_samples=fade_samples, downsample=downsample, mono=mono)
+                self._compiled = load_compiled(notes_dir, fade_samples=fade_samples, downsample=downsample, mono=mono)
+
+    @staticmethod
+    def scan(*scores):
+        # 掃描樂譜，回傳用到的音符名稱
+        names = set()
+        for score in scores:
+            for note in score:
+                for n in (note if isinstance(note, list) else [note]):
+                    if n != 0 and n in note_to_name:
+                        names.add(note_to_name[n])
+        return names
+
+    def preload(self, names):
+        for name in names:
+            self.get(name)
+
+    def _read(self, name):
+        _, wav_data = wavfile.read(os.path.join(self.notes_dir, f'{name}.wav'))
+        return wav_data
+
+    def nearest_recorded(self, name):
+        # 最近的有錄音的鍵；距離相同時選較高的鍵(往下移調不會產生混疊)
+        if self._recorded is None:
+            self._recorded = [name_to_note[recorded] for recorded in _source_stats(self.notes_dir)]
+        note = name_to_note[name]
+        candidates = [n for n in self._recorded if abs(n - note) <= MAX_SHIFT]
+        if not candidates:
+            return None
+        return note_to_name[min(candidates, key=lambda n: (abs(n - note), n < note))]
+
+    def _decode(self, name):
+        try:
+            return reduce_frames(prepare_frames(self._read(name), self.fade_samples), self.downsample, self.mono)
+        except FileNotFoundError:
+            pass
+
+        source = self.nearest_recorded(name)
+        if source is None:
+            print(f"警告: 找不到 {self.notes_dir}/{name}.wav，該音符將無聲")
+            self.missing.add(name)
+            return np.zeros((self.sample_rate, self.channels), dtype=np.float32)
+        # 由原始錄音移調後再套用淡入，合成結果與一般音符一樣放在 LRU 快取中
+        self.synthesized.add(name)
+        semitones = name_to_note[name] - name_to_note[source]
+        frames = prepare_frames(pitch_shift(self._read(source), semitones), self.fade_samples)
+        return reduce_frames(frames, self.downsample, self.mono)
+
+    def get(self, name):
+        if self._compiled is not None:
+            data, index = self._compiled
+            if name in index:
+                offset, frames = index[name]
+                return data[offset:offset + frames]
+
+        frames = self._samples.get(name)
+        if frames is not None:
+            self._samples.move_to_end(name)
+            return frames
+
+        frames = self._decode(name)
+        self._samples[name] = frames
+        self.resident_bytes += frames.nbytes
+        self._evict(keep=name)
+        return frames
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        while self.resident_bytes > self.max_bytes and len(self._samples) > 1:
+            name, frames = next(iter(self._samples.items()))
+            if name == keep:
+                break
+            del self._samples[name]
+            self._sounds.pop(name, None)
+            self.resident_bytes -= frames.nbytes
+
+    def get_sound(self, name):
+        # 由同一份音色資料建立播放用的 Sound
+        sound = self._sounds.get(name)
+        if sound is None:
+            import pygame
+            frames = self.get(name)
+            if name in self.missing:
+                return None
+            # make_sound 不轉換格式：裝置必須是音色庫的取樣率、16-bit、相同聲道數(main.init_audio 固定的格式)
+            device = pygame.mixer.get_init()
+            if device != (self.sample_rate, -16, self.channels):
+                raise RuntimeError(f"音效裝置格式 {device} 與音色庫不符"
+                                   f"(需要 {self.sample_rate}Hz、16-bit、{self.channels} 聲道)，請先呼叫 init_audio()")
+            sound = pygame.sndarray.make_sound(frames.astype(np.int16))
+            self._sounds[name] = sound
+        return sound
+
+    @property
+    def version(self):
+        # 音色庫版本：來源 WAV 或淡入設定改變時會變，用於渲染快取的鍵值
+        if self._version is None:
+            state = [SAMPLE_RATE, self.fade_samples, _source_stats(self.notes_dir)]
+            if self.downsample > 1 or self.mono:
+                state += [self.downsample, self.mono]
+            self._version = hashlib.sha1(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+        return self._version
+
+    def publish_shared(self, names=None):
+        # 把音色庫複製到共享記憶體(只做一次)，回傳可以傳給其他行程的 handle(可 pickle 的 dict)；
+        # 其他行程以 SampleBank.attach_shared(handle) 取得零複製的唯讀 view，不需要重新解碼
+        from multiprocessing import shared_memory
+        names = sorted(set(note_to_name.values()) if names is None else set(names), key=name_to_note.get)
+        frames_list = [self.get(name) for name in names]
+        index = {}
+        offset = 0
+        for name, frames in zip(names, frames_list):
+            index[name] = [offset, len(frames)]
+            offset += len(frames)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset * self.channels * 4, 1))
+        data = np.ndarray((offset, self.channels), dtype=np.float32, buffer=shm.buf)
+        for (start, length), frames in zip(index.values(), frames_list):
+            data[start:start + length] = frames
+
+        # 這個行程之後也改用共享的資料，原本解碼的副本可以釋放
+        data.flags.writeable = False
+        self._shared = shm
+        self._compiled = (data, index)
+        self._samples.clear()
+        self.resident_bytes = 0
+        return {
+            'name': shm.name,
+            'index': index,
+            'total_frames': offset,
+            'notes_dir': self.notes_dir,
+            'fade_samples': self.fade_samples,
+            'downsample': self.downsample,
+            'mono': self.mono,
+            'missing': sorted(self.missing),
+            'synthesized': sorted(self.synthesized),
+            'version': self.version,
+        }
+
+    @classmethod
+    def attach_shared(cls, handle):
+        # 連接到 publish_shared 建立的共享記憶體，所有音符都是唯讀的 NumPy view
+        from multiprocessing import shared_memory
+        try:
+            shm = shared_memory.SharedMemory(name=handle['name'], track=False)
+        except TypeError:
+            # Python 3.13 之前沒有 track 參數：連接時暫時不向 resource_tracker 登記，
+            # 否則這個行程結束時會把共享記憶體刪除(fork 的 worker 與主行程共用同一個 tracker)
+            from multiprocessing import resource_tracker
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                shm = shared_memory.SharedMemory(name=handle['name'])
+            finally:
+                resource_tracker.register = register
+
+        bank = cls(handle['notes_dir'], fade_samples=handle['fade_samples'], use_compiled=False,
+                   downsample=handle['downsample'], mono=handle['mono'])
+        data = np.ndarray((handle['total_frames'], bank.channels), dtype=np.float32, buffer=shm.buf)
+        data.flags.writeable = False
+        bank._shared = shm
+        bank._compiled = (data, handle['index'])
+        bank.missing = set(handle['missing'])
+        bank.synthesized = set(handle['synthesized'])
+        bank._version = handle['version']
+        return bank
+
+    def close_shared(self):
+        # 由 publish_shared 的行程呼叫：釋放共享記憶體(其他行程應已結束)
+        if self._shared is not None:
+            self._compiled = None
+            try:
+                self._shared.close()
+            except BufferError:
+                pass  # 仍有 view 在使用中，等它們被回收時才會解除映射
+            self._shared.unlink()
+            self._shared = None
+
+    def __contains__(self, name):
+        if self._compiled is not None and name in self._compiled[1]:
+            return True
+        return name in self._samples
+
+    def __len__(self):
+        return len(self._samples)
+
+
+def make_sparse(notes_dir, output_dir, step=3):
+    # 每 step 個鍵保留一個錄音，複製到 output_dir，回傳保留的音符名稱
+    os.makedirs(output_dir, exist_ok=True)
+    lowest = min(note_to_name)
+    kept = [name for note, name in sorted(note_to_name.items()) if (note - lowest) % step == 0]
+    for name in kept:
+        shutil.copy2(os.path.join(notes_dir, f'{name}.wav'), os.path.join(output_dir, f'{name}.wav'))
+    return kept
+
+
+def snr_db(reference, synthesized):
+    noise = np.sum((reference - synthesized) ** 2)
+    return float(10 * np.log10(np.sum(reference ** 2) / noise)) if noise > 0 else float('inf')
+
+
+def spectral_distance_db(reference, synthesized, frame=2048):
+    # 對數頻譜距離：逐音框比較頻譜大小，不受錄音之間相位差的影響
+    n = min(len(reference), len(synthesized)) // frame * frame
+    window = np.hanning(frame)
+    spectra = [20 * np.log10(np.abs(np.fft.rfft(x[:n].mean(axis=1).reshape(-1, frame) * window, axis=1)) + 1e-6)
+               for x in (reference, synthesized)]
+    return float(np.mean(np.sqrt(np.mean((spectra[0] - spectra[1]) ** 2, axis=1))))
+
+
+def resample_quality(sparse_dir, full_dir='notes'):
+    # 以完整音色庫衡量稀疏音色庫合成的音符：
+    # 回傳 {音符: (來源音符, SNR dB, 對數頻譜距離 dB, 直接使用未移調來源的頻譜距離 dB)}
+    bank = SampleBank(sparse_dir, use_compiled=False)
+    results = {}
+    for name in sorted(set(_source_stats(full_dir)) - set(_source_stats(sparse_dir)), key=name_to_note.get):
+        _, wav_data = wavfile.read(os.path.join(full_dir, f'{name}.wav'))
+        reference = prepare_frames(wav_data, bank.fade_samples)
+        synthesized = bank.get(name)
+        source = bank.nearest_recorded(name)
+        unshifted = bank.get(source)
+        n = min(len(reference), len(synthesized), len(unshifted))
+        results[name] = (source, snr_db(reference[:n], synthesized[:n]),
+                         spectral_distance_db(reference[:n], synthesized[:n]),
+                         spectral_distance_db(reference[:n], unshifted[:n]))
+    return results
+
+
+if __name__ == "__main__":
+    # 預先編譯音色庫：python3 sample_bank.py [notes 資料夾]
+    # 產生稀疏音色庫：python3 sample_bank.py --sparse 3 -o notes_sparse
+    # 量測合成品質：  python3 sample_bank.py notes_sparse --quality notes
+    parser = argparse.ArgumentParser(description="音色庫工具")
+    parser.add_argument('notes_dir', nargs='?', default='notes', help="音色庫資料夾")
+    parser.add_argument('--sparse', type=int, metavar='N', help="只保留每 N 個鍵的錄音")
+    parser.add_argument('-o', '--output', help="稀疏音色庫的輸出資料夾")
+    parser.add_argument('--quality', metavar='FULL_DIR', help="與完整音色庫比較合成音符的品質")
+    args = parser.parse_args()
+
+    if args.sparse:
+        if not args.output:
+            parser.error("--sparse 需要指定 -o 輸出資料夾")
+        kept = make_sparse(args.notes_dir, args.output, args.sparse)
+        print(f"已產生稀疏音色庫: {args.output}({len(kept)}/{len(note_to_name)} 個鍵)")
+    elif args.quality:
+        results = resample_quality(args.notes_dir, args.quality)
+        for name, (source, snr, distance, unshifted) in results.items():
+            print(f"{name:>4} <- {source:<4} SNR {snr:6.2f} dB  頻譜距離 {distance:6.2f} dB(未移調 {unshifted:6.2f} dB)")
+        if results:
+            print(f"平均 SNR {np.mean([r[1] for r in results.values()]):.2f} dB，"
+                  f"平均頻譜距離 {np.mean([r[2] for r in results.values()]):.2f} dB"
+                  f"(未移調 {np.mean([r[3] for r in results.values()]):.2f} dB)")
+    else:
+        path = compile_samples(args.notes_dir)
+        print(f"已編譯音色庫: {path}")
@@ -0,0 +1,35 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class PlaybackScheduler:
+    # 統一的播放排程器：所有聲部的事件放在同一個依時間排序的堆積，
+    # 以 time.perf_counter(單調時鐘)為準，直接睡到下一個事件的時間點，不做輪詢
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()  # 同一時間點的事件依加入順序執行
+        self.lateness = []             # 每個音符事件的 (聲部, 延遲秒數)
+
+    def add(self, at, callback, *args, tag=None):
+        # at：相對於開始播放的秒數；有 tag 的事件會記錄延遲
+        heapq.heappush(self._heap, (at, next(self._seq), tag, callback, args))
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def run(self):
+        start = self.clock()
+        while self._heap:
+            at, _, tag, callback, args = self._heap[0]
+            delay = start + at - self.clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(self._heap)
+            if tag is not None:
+                self.lateness.append((tag, -delay))
+            callback(*args)
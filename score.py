@@ -0,0 +1,275 @@
+import os
+import sys
+import numbers
+import struct
+import numpy as np
+from notes import note_to_name
+
+# 編譯後的樂譜格式：和弦攤平成多列，每列一個音符(休止符為 note=0 的一列)
+#   hand     聲部索引(0: 右手, 1: 左手)
+#   step     在該聲部中的第幾個 score/beat(同一個和弦共用 step)
+#   onset    起始拍數
+#   duration 拍數
+#   note     音符數字
+#   bar_end  這一步結束時剛好滿四拍(小節結尾淡出)
+SCORE_DTYPE = np.dtype([
+    ('hand', 'u1'),
+    ('step', '<i4'),
+    ('onset', '<f8'),
+    ('duration', '<f8'),
+    ('note', '<i2'),
+    ('bar_end', '?'),
+])
+HAND_NAMES = ('right', 'left')
+HAND_GAINS = (0.7, 0.5)  # 右手、左手音量
+HAND_LABELS = {'right': '右手', 'left': '左手'}
+
+# 每一軌的混音參數
+TRACK_DTYPE = np.dtype([
+    ('name', 'S16'),
+    ('gain', '<f8'),   # 音量
+    ('pan', '<f8'),    # 左右平衡：-1 全左、0 置中、1 全右
+])
+
+# 樂譜指定的踏板事件；沒有任何事件的聲部使用每小節踩一次的預設踏板
+PEDAL_SCORE_DTYPE = np.dtype([
+    ('hand', 'u1'),
+    ('beat', '<f8'),   # 起始拍數
+    ('down', '?'),     # True: 踩下 / False: 放開
+])
+
+# 編譯樂譜檔(.score)格式：magic(8) + tempo(float64) + 聲部數(uint32) + 列數(uint32)
+#   + 每個聲部的 beat 總和(float64) + [PNOSCOR2 起: TRACK_DTYPE 軌道表]
+#   + [PNOSCOR3: 踏板事件數(uint32) + PEDAL_SCORE_DTYPE 踏板事件] + SCORE_DTYPE 原始資料，
+#   讀取時直接 frombuffer；PNOSCOR1 沒有軌道表，視為右手、左手兩軌
+SCORE_MAGIC = b'PNOSCOR3'
+SCORE_MAGIC_V2 = b'PNOSCOR2'
+SCORE_MAGIC_V1 = b'PNOSCOR1'
+SCORE_HEADER = struct.Struct('<8sdII')
+PEDAL_COUNT = struct.Struct('<I')
+
+
+class Track:
+    # 樂譜中的一軌：score/beat 與這一軌的音量、左右平衡；
+    # pedal 為 [(拍數, 是否踩下), ...] 的踏板事件，None 表示每小節踩一次踏板
+    def __init__(self, name, score, beat, gain=1.0, pan=0.0, pedal=None):
+        self.name = name
+        self.score = score
+        self.beat = beat
+        self.gain = gain
+        self.pan = pan
+        self.pedal = pedal
+
+
+def hand_tracks(right_score, right_beat, left_score, left_beat):
+    # 原本左右手的樂譜對應到兩軌
+    return [Track(name, score, beat, gain) for name, score, beat, gain in
+            zip(HAND_NAMES, (right_score, left_score), (right_beat, left_beat), HAND_GAINS)]
+
+
+def default_track_table(num_tracks):
+    tracks = np.zeros(num_tracks, dtype=TRACK_DTYPE)
+    for i in range(num_tracks):
+        tracks[i] = (HAND_NAMES[i] if i < len(HAND_NAMES) else f'track{i}',
+                     HAND_GAINS[i] if i < len(HAND_GAINS) else 1.0, 0.0)
+    return tracks
+
+
+class CompiledScore:
+    def __init__(self, tempo, events, total_beats, tracks=None, pedals=None):
+        self.tempo = tempo
+        self.events = events            # SCORE_DTYPE 結構化陣列
+        self.total_beats = total_beats  # 每個聲部 beat 的總和(決定曲長)
+        self.tracks = tracks if tracks is not None else default_track_table(len(total_beats))  # TRACK_DTYPE
+        self.pedals = pedals if pedals is not None else np.zeros(0, dtype=PEDAL_SCORE_DTYPE)
+
+    @property
+    def names(self):
+        return [name.decode('utf-8') for name in self.tracks['name'].tolist()]
+
+    def index(self, hand):
+        return self.names.index(hand) if isinstance(hand, str) else hand
+
+    def part(self, hand):
+        return self.events[self.events['hand'] == self.index(hand)]
+
+    def pedal(self, hand):
+        # 一個聲部的踏板事件；沒有指定時回傳 None(每小節踩一次)
+        rows = self.pedals[self.pedals['hand'] == self.index(hand)]
+        return rows if len(rows) else None
+
+    def part_sheet(self, hand):
+        # 一個聲部轉回 (score, beat)
+        score, beat = [], []
+        part = self.part(hand)
+        steps, starts = np.unique(part['step'], return_index=True)
+        for rows in np.split(part, starts[1:]):
+            notes = [int(n) for n in rows['note'] if n != 0]
+            score.append(notes if len(notes) > 1 else (notes[0] if notes else 0))
+            beat.append(float(rows['duration'][0]))
+        return score, beat
+
+    def to_tracks(self, sheets=True):
+        # 轉回 [Track, ...]，供播放使用；sheets=False 時只有軌道設定，score/beat 為 None(不逐音符轉回 list)
+        tracks = []
+        for i, (name, gain, pan) in enumerate(zip(self.names, self.tracks['gain'].tolist(),
+                                                  self.tracks['pan'].tolist())):
+            pedal = self.pedal(i)
+            if pedal is not None:
+                pedal = list(zip(pedal['beat'].tolist(), pedal['down'].tolist()))
+            score, beat = self.part_sheet(i) if sheets else (None, None)
+            tracks.append(Track(name, score, beat, gain=float(gain), pan=float(pan), pedal=pedal))
+        return tracks
+
+    def to_sheet(self):
+        # 轉回 (tempo, right_score, right_beat, left_score, left_beat)
+        sheet = [self.tempo]
+        for hand in range(len(HAND_NAMES)):
+            sheet += self.part_sheet(hand)
+        return tuple(sheet)
+
+
+def compile_part(score, beat, hand=0, strict=False, label='', warn=True):
+    # 把一個聲部的 score/beat 攤平並驗證，回傳 (結構化陣列, beat 總和)
+    problems = []
+    if len(score) != len(beat):
+        problems.append(f"score 有 {len(score)} 個、beat 有 {len(beat)} 個，多出的部分會被忽略")
+
+    rows = []
+    onset = 0
+    current_measure_beats = 0
+    for step, (note, beat_value) in enumerate(zip(score, beat)):
+        if not isinstance(beat_value, numbers.Real):
+            raise ValueError(f"樂譜{label}錯誤: 第 {step} 個 beat 不是數字: {beat_value!r}")
+        if beat_value <= 0:
+            problems.append(f"第 {step} 個 beat 無效: {beat_value!r}")
+        current_measure_beats += beat_value
+        bar_end = current_measure_beats >= 4
+        if bar_end:
+            current_measure_beats -= 4
+
+        notes = []
+        for n in (note if isinstance(note, list) else [note]):
+            if n == 0:
+                continue
+            if n not in note_to_name:
+                problems.append(f"第 {step} 個音符無效: {n!r}")
+                continue
+            notes.append(n)
+        for n in notes or [0]:
+            rows.append((hand, step, onset, beat_value, n, bar_end))
+        onset += beat_value
+
+    for problem in problems:
+        if strict:
+            raise ValueError(f"樂譜{label}錯誤: {problem}")
+        if warn:
+            print(f"警告: 樂譜{label} {problem}")
+
+    return np.array(rows, dtype=SCORE_DTYPE), sum(beat)
+
+
+def check_track_names(tracks):
+    # 軌道以名稱查詢，名稱必須唯一，且要放得進 .score 軌道表的固定長度欄位
+    max_bytes = TRACK_DTYPE['name'].itemsize
+    seen = set()
+    for track in tracks:
+        if len(track.name.encode('utf-8')) > max_bytes:
+            raise ValueError(f"軌道名稱 '{track.name}' 超過 {max_bytes} 位元組")
+        if track.name in seen:
+            raise ValueError(f"軌道名稱重複: '{track.name}'")
+        seen.add(track.name)
+
+
+def compile_pedal(pedal, hand=0, label=''):
+    # 驗證踏板事件 [(拍數, 是否踩下), ...]；空的列表表示整首踩著踏板
+    rows = []
+    for i, event in enumerate(pedal):
+        try:
+            beat_value, down = event
+        except (TypeError, ValueError):
+            raise ValueError(f"樂譜{label}錯誤: 第 {i} 個踏板事件應為 (拍數, 是否踩下): {event!r}")
+        if not isinstance(beat_value, numbers.Real) or beat_value < 0:
+            raise ValueError(f"樂譜{label}錯誤: 第 {i} 個踏板事件的拍數無效: {beat_value!r}")
+        rows.append((hand, beat_value, bool(down)))
+    return np.array(rows or [(hand, 0.0, True)], dtype=PEDAL_SCORE_DTYPE)
+
+
+def compile_tracks(tempo, tracks, strict=False):
+    check_track_names(tracks)
+    labels = [HAND_LABELS.get(track.name, f'「{track.name}」') for track in tracks]
+    parts = [compile_part(track.score, track.beat, hand, strict, label)
+             for hand, (track, label) in enumerate(zip(tracks, labels))]
+    pedals = [compile_pedal(track.pedal, hand, label)
+              for hand, (track, label) in enumerate(zip(tracks, labels)) if track.pedal is not None]
+    table = np.array([(track.name.encode('utf-8'), track.gain, track.pan) for track in tracks], dtype=TRACK_DTYPE)
+    return CompiledScore(tempo, np.concatenate([part for part, _ in parts]),
+                         np.array([total for _, total in parts]), table,
+                         np.concatenate(pedals) if pedals else None)
+
+
+def compile_sheet(tempo, right_score, right_beat, left_score, left_beat, strict=False):
+    return compile_tracks(tempo, hand_tracks(right_score, right_beat, left_score, left_beat), strict)
+
+
+def save_score(path, compiled):
+    total_beats = np.asarray(compiled.total_beats, dtype='<f8')
+    with open(path, 'wb') as f:
+        f.write(SCORE_HEADER.pack(SCORE_MAGIC, compiled.tempo, len(total_beats), len(compiled.events)))
+        f.write(total_beats.tobytes())
+        f.write(np.ascontiguousarray(compiled.tracks, dtype=TRACK_DTYPE).tobytes())
+        f.write(PEDAL_COUNT.pack(len(compiled.pedals)))
+        f.write(np.ascontiguousarray(compiled.pedals, dtype=PEDAL_SCORE_DTYPE).tobytes())
+        f.write(np.ascontiguousarray(compiled.events, dtype=SCORE_DTYPE).tobytes())
+
+
+def load_score(path):
+    # 讀取編譯後的樂譜，不會執行任何 Python 程式碼
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, tempo, num_hands, num_rows = SCORE_HEADER.unpack_from(data)
+    if magic not in (SCORE_MAGIC, SCORE_MAGIC_V2, SCORE_MAGIC_V1):
+        raise ValueError(f"不是編譯後的樂譜檔: {path}")
+    offset = SCORE_HEADER.size
+    total_beats = np.frombuffer(data, dtype='<f8', count=num_hands, offset=offset)
+    offset += 8 * num_hands
+    tracks = None
+    if magic != SCORE_MAGIC_V1:
+        tracks = np.frombuffer(data, dtype=TRACK_DTYPE, count=num_hands, offset=offset)
+        offset += TRACK_DTYPE.itemsize * num_hands
+    pedals = None
+    if magic == SCORE_MAGIC:
+        (num_pedals,) = PEDAL_COUNT.unpack_from(data, offset)
+        offset += PEDAL_COUNT.size
+        pedals = np.frombuffer(data, dtype=PEDAL_SCORE_DTYPE, count=num_pedals, offset=offset)
+        offset += PEDAL_SCORE_DTYPE.itemsize * num_pedals
+    events = np.frombuffer(data, dtype=SCORE_DTYPE, count=num_rows, offset=offset)
+    return CompiledScore(tempo, events, total_beats, tracks, pedals)
+
+
+def convert_sheet(sheet_name, output_dir='sheets', strict=False):
+    # 把 sheets/<sheet_name>.py 轉成 <output_dir>/<sheet_name>.score
+    from main import load_sheet_music
+    sheet_data = load_sheet_music(sheet_name, strict=strict)
+    if not sheet_data:
+        return None
+    path = os.path.join(output_dir, f'{sheet_name}.score')
+    if isinstance(sheet_data, CompiledScore):
+        save_score(path, sheet_data)
+    else:
+        save_score(path, compile_sheet(*sheet_data, strict=strict))
+    return path
+
+
+if __name__ == "__main__":
+    # 轉換並驗證樂譜：python3 score.py [--strict] river wedding
+    args = sys.argv[1:]
+    strict = '--strict' in args
+    for sheet_name in [arg for arg in args if arg != '--strict']:
+        try:
+            path = convert_sheet(sheet_name, strict=strict)
+        except ValueError as e:
+            print(f"錯誤: {e}")
+            sys.exit(1)
+        if path:
+            print(f"已編譯樂譜: {path}")